@@ -9,36 +9,395 @@ Execution logic for CC.
 Handles the transformation of settings files (the YAML file) to actions.
 """
 
-from distutils.version import LooseVersion
 import os
 import sys  # noqa
 import re
+import json
+import hashlib
 import glob
 import shutil
+import datetime
+import threading
+import traceback
 from . import stdtools  # noqa
 from .stdtools import Handler
 from .stdtools import tracebacker
 from .stdtools import say
+from .stdtools import command_check
+from .stdtools import tag_output
 from .statetools import Convey
 from .installers import SingularityManager
 from .installers import LmodManager
 from .misc import write_user_yaml
+from .misc import parse_bytes
+from .registry import fetch_tags
+from .registry import resolve_tags
+from .registry import TagCache
+from .registry import read_snapshot
+from .registry import VersionIndex
+from .registry import resolve_digests
 from .settings import cc_user, default_modulefile_settings, specs
-from .stdtools import bash
+from .settings import modulefiles_store
+from .settings import spider_cache
+from .settings import cc_lock
+from .stdtools import probe
 from .modulefile_templates import modulefile_basic
 from .modulefile_templates import modulefile_sandbox
 from .modulefile_templates import shell_connection_run
 from .modulefile_templates import shell_connection_exec
 
 
+# managers run in threads and can register errors at the same time
+errors_lock = threading.Lock()
+
+
 def register_error(self, name, error):
     """
     During development we track errors in the cache.
     This could be moved inside a class later.
     """
-    if 'errors' not in self.cache:
-        self.cache['errors'] = {}
-    self.cache['errors'][name] = error
+    with errors_lock:
+        if 'errors' not in self.cache:
+            self.cache['errors'] = {}
+        self.cache['errors'][name] = error
+
+
+def run_managers(self, managers):
+    """
+    Run independent manager Handlers at the same time, one thread each.
+    The managers are (name, Handler, kwargs) and their output is tagged with
+    the name. Exceptions are registered as errors under the name.
+    Returns the instances by name, or None for those that failed.
+    Before python 3.8 stdtools has no asyncio runner, so the managers run
+    one after another.
+    """
+    instances = {}
+    # errors registered during this run, since older ones stay in the cache
+    registered = set()
+    # create the shared parts of the state before the threads use them
+    self.cache.setdefault('probes', {})
+    self.cache.setdefault('profile_mods', {})
+
+    def register(handler, name, error):
+        registered.add(name)
+        register_error(handler, name=name, error=error)
+
+    def run(name, manager, kwargs):
+        tag_output(say('[%s]' % name, 'gray'))
+        try:
+            instances[name] = Convey(
+                cache=self.cache,
+                _register_error=register)(manager)(**kwargs)
+        except Exception as e:
+            instances[name] = None
+            if self._debug:
+                tracebacker(e)
+            # keep an error that the manager registered before raising
+            if name in registered:
+                return
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            register_error(self, name=name, error={
+                'formatted': traceback.format_tb(exc_tb),
+                'result': str(exc_obj)})
+        finally:
+            tag_output(None)
+    if not stdtools.use_runner:
+        for item in managers:
+            run(*item)
+        return instances
+    threads = [threading.Thread(target=run, args=item) for item in managers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return instances
+
+
+def whitelist_filter(whitelist, blacklist=None):
+    """Remove blacklisted entries from the whitelist."""
+    if blacklist and not isinstance(blacklist, list):
+        raise Exception('the blacklist must be a list: %s' %
+                        str(blacklist))
+    if blacklist:
+        whitelist = dict([(i, j) for i, j in whitelist.items()
+                         if i not in blacklist])
+    return whitelist
+
+
+def whitelist_requests(whitelist):
+    """Preprocess every whitelist entry with PrepModuleRequest."""
+    return [PrepModuleRequest(name=key, detail=val).solve
+            for key, val in whitelist.items()]
+
+
+def docker_repos(prepped, module_settings):
+    """List the docker repositories behind a preprocessed whitelist."""
+    return [item.get('repo') or item['name'] for item in prepped
+            if (item.get('source') or
+                module_settings.get('source')) == 'docker']
+
+
+def docker_requests(prepped, module_settings):
+    """Pair each docker request on the whitelist with its repository."""
+    return list(zip(
+        [i for i in prepped if (i.get('source') or
+         module_settings.get('source')) == 'docker'],
+        docker_repos(prepped, module_settings)))
+
+
+def exact_tags(prepped, module_settings):
+    """
+    Map each docker repository to the exact tags requested from it, or to
+    None when any request needs the full list to compare versions.
+    """
+    wanted = {}
+    for item, repo in docker_requests(prepped, module_settings):
+        target = str(item.get('version', 'latest'))
+        op, version, suffix = VersionCheck._version_syntax(target)
+        if op not in (None, '=', '=='):
+            wanted[repo] = None
+        elif repo not in wanted or wanted[repo] is not None:
+            # unparsed versions like "latest" are exact tags
+            tag = target if suffix is None else version+suffix
+            wanted[repo] = wanted.get(repo, set()) | set([tag])
+    return wanted
+
+
+def fetch_repos(repos, module_settings, wanted=None):
+    """
+    Fetch tags for many repositories using the concurrency and registry
+    cache lifetime from the module_settings.
+    """
+    workers = module_settings.get(
+        'resolve_workers',
+        default_modulefile_settings['resolve_workers'])
+    # registry responses are cached on disk between refreshes
+    cache = TagCache(ttl=module_settings.get(
+        'registry_ttl', default_modulefile_settings['registry_ttl']))
+    tags = resolve_tags(repos, workers=workers, cache=cache, wanted=wanted)
+    cache.write()
+    return tags
+
+
+def selected_tags(prepped, module_settings, tags):
+    """
+    Solve the docker versions on the whitelist against the indexed tags so
+    that we can find all of their digests at once. Requests which cannot be
+    solved are skipped here and reported later by ModuleRequest.
+    """
+    selected = {}
+    for item, repo in docker_requests(prepped, module_settings):
+        if not isinstance(tags.get(repo), VersionIndex):
+            continue
+        try:
+            versions = VersionCheck(
+                name=repo, docker_version=item.get('version', 'latest'),
+                semantic_version=item.get('semantic_version'),
+                tags=tags[repo]).solve
+        except Exception:
+            continue
+        selected[repo] = selected.get(repo, set()) | set(versions)
+    return selected
+
+
+def fetch_repo_digests(wanted, module_settings):
+    """
+    Fetch the digests for the selected tags which the tag lists omit and
+    save them with the cached tags.
+    """
+    digests = resolve_digests(wanted, workers=module_settings.get(
+        'resolve_workers', default_modulefile_settings['resolve_workers']))
+    cache = TagCache(ttl=module_settings.get(
+        'registry_ttl', default_modulefile_settings['registry_ttl']))
+    for name, result in digests.items():
+        if isinstance(result, Exception):
+            print('warning cannot pin the images for %s: %s' % (name, result))
+        else:
+            cache.store_digests(name, result)
+    cache.write()
+    return dict([(k, v) for k, v in digests.items()
+                 if not isinstance(v, Exception)])
+
+
+def read_lockfile():
+    """Get the digests for each docker repository from the lockfile."""
+    import yaml
+    if not os.path.isfile(cc_lock):
+        return {}
+    with open(cc_lock) as fp:
+        lock = yaml.load(fp, Loader=yaml.SafeLoader) or {}
+    digests = {}
+    for detail in lock.values():
+        if detail.get('source', '').startswith('docker://'):
+            repo = detail['source'][len('docker://'):].rstrip(':')
+            digests.setdefault(repo, {}).update(dict([
+                (k, v) for k, v in detail.get('versions', {}).items() if v]))
+    return digests
+
+
+def write_lockfile(records):
+    """Record the digest for each version of each module after refresh."""
+    import yaml
+    lock = dict([(name, dict(source=record['source'], versions=dict([
+        (i, record.get('digests', {}).get(i)) for i in record['versions']])))
+        for name, record in records.items()])
+    fn_temp = '%s.tmp' % cc_lock
+    with open(fn_temp, 'w') as fp:
+        fp.write('# written by ./cc refresh: the digest for each version\n')
+        yaml.dump(lock, fp, default_flow_style=False)
+    os.rename(fn_temp, cc_lock)
+
+
+def flip_link(link, target):
+    """Point a symlink at a new target with a single atomic rename."""
+    link_temp = '%s.tmp' % link
+    if os.path.lexists(link_temp):
+        os.remove(link_temp)
+    os.symlink(target, link_temp)
+    os.rename(link_temp, link)
+
+
+def generation_links(generation):
+    """Map module names to store entries for one generation."""
+    dn = os.path.join(modulefiles_store, generation)
+    return dict([(name, os.path.basename(os.readlink(os.path.join(dn, name))))
+                 for name in os.listdir(dn)])
+
+
+def link_modulefiles(modulefiles, names):
+    """
+    Point a stable link in the modulefiles tree at each name in the current
+    generation. Links for names that are not in the current generation yet
+    dangle, so Lmod ignores them until the current link is flipped.
+    """
+    current = os.path.join(modulefiles_store, 'current')
+    for name in names:
+        link = os.path.join(modulefiles, name)
+        target = os.path.relpath(os.path.join(current, name), modulefiles)
+        if os.path.islink(link) and os.readlink(link) == target:
+            continue
+        # move modulefiles written in place by earlier versions of cc
+        if os.path.isdir(link) and not os.path.islink(link):
+            os.rename(link, '%s.old' % link)
+            flip_link(link, target)
+            shutil.rmtree('%s.old' % link)
+        else:
+            flip_link(link, target)
+
+
+def sync_modulefiles(modulefiles):
+    """
+    Match the modulefiles tree to the current generation after a flip.
+    Links for names which left the generation already dangle, so removing
+    them does not change what Lmod sees.
+    """
+    names = os.listdir(os.path.join(modulefiles_store, 'current'))
+    link_modulefiles(modulefiles, names)
+    # remove entries that left the whitelist, except those provided by cc
+    dn_safe = [os.path.realpath(os.path.join(modulefiles, 'cc'))]
+    for dn in glob.glob(os.path.join(modulefiles, '*')):
+        if os.path.basename(dn) in names or os.path.realpath(dn) in dn_safe:
+            continue
+        print('status removing modulefiles for %s' % os.path.basename(dn))
+        if os.path.islink(dn):
+            os.remove(dn)
+        else:
+            shutil.rmtree(dn)
+
+
+def prune_store():
+    """Keep only the current and previous generations and their entries."""
+    keep = [os.readlink(os.path.join(modulefiles_store, i))
+            for i in ['current', 'previous']
+            if os.path.islink(os.path.join(modulefiles_store, i))]
+    entries = set([i for j in keep for i in generation_links(j).values()])
+    for dn in glob.glob(os.path.join(modulefiles_store, 'gen-*')):
+        if os.path.basename(dn) not in keep:
+            shutil.rmtree(dn)
+    for dn in glob.glob(os.path.join(modulefiles_store, 'entries', '*')):
+        if os.path.basename(dn) not in entries:
+            shutil.rmtree(dn)
+
+
+def publish_modulefiles(modulefiles, entries):
+    """
+    Publish a generation of modulefiles from the store with one symlink flip.
+    The entries map each module name to its directory in the store. The
+    previous generation is kept so that it can be restored instantly.
+    """
+    current = os.path.join(modulefiles_store, 'current')
+    if os.path.islink(current) and \
+            generation_links(os.readlink(current)) == entries:
+        print('status modulefiles are unchanged')
+        changed = False
+    else:
+        generation = 'gen-%s' % datetime.datetime.now().strftime(
+            '%Y%m%d%H%M%S%f')
+        dn = os.path.join(modulefiles_store, generation)
+        os.makedirs('%s.tmp' % dn)
+        for name, entry in entries.items():
+            os.symlink(os.path.join('..', 'entries', entry),
+                       os.path.join('%s.tmp' % dn, name))
+        os.rename('%s.tmp' % dn, dn)
+        # link new names first so that they appear with the flip
+        link_modulefiles(modulefiles, entries)
+        if os.path.islink(current):
+            flip_link(os.path.join(modulefiles_store, 'previous'),
+                      os.readlink(current))
+        flip_link(current, generation)
+        print('status published modulefiles generation %s' % generation)
+        changed = True
+    sync_modulefiles(modulefiles)
+    prune_store()
+    return changed
+
+
+def rollback_modulefiles(modulefiles):
+    """Swap the current and previous generations of modulefiles."""
+    current = os.path.join(modulefiles_store, 'current')
+    previous = os.path.join(modulefiles_store, 'previous')
+    if not os.path.islink(previous):
+        raise Exception('there is no previous generation of modulefiles')
+    generation, generation_prev = os.readlink(current), os.readlink(previous)
+    link_modulefiles(modulefiles, generation_links(generation_prev))
+    flip_link(current, generation_prev)
+    flip_link(previous, generation)
+    sync_modulefiles(modulefiles)
+    print('status restored modulefiles generation %s' % generation_prev)
+
+
+def update_spider_cache(lmod_root, modulefiles, enable=True):
+    """
+    Write an Lmod spider cache for the modulefiles tree so that listing
+    modules costs one file read instead of evaluating every modulefile.
+    The cache is removed when it is disabled or cannot be built, because a
+    stale cache would hide changes to the tree.
+    """
+    if not enable:
+        if os.path.isdir(spider_cache):
+            print('status removing the spider cache')
+            shutil.rmtree(spider_cache)
+        return
+    script = os.path.join(
+        lmod_root, 'lmod', 'libexec', 'update_lmod_system_cache_files')
+    if not os.path.isfile(script):
+        print('warning cannot find %s so we cannot write a spider cache' %
+              script)
+        return update_spider_cache(lmod_root, modulefiles, enable=False)
+    if not os.path.isdir(spider_cache):
+        os.makedirs(spider_cache)
+    # the timestamp tells Lmod that the cache is current. the modulefiles
+    #   skip their image checks while Lmod evaluates them for the cache
+    print('status writing the spider cache')
+    result = command_check(
+        '_COMCOL_SPIDER_CACHE=1 _COMCOL_ROOT=%s %s -d %s -t %s %s' % (
+            os.path.realpath(os.getcwd()), script,
+            os.path.abspath(spider_cache),
+            os.path.abspath(os.path.join(spider_cache, 'timestamp')),
+            os.path.abspath(modulefiles)))
+    if result != 0:
+        print('warning failed to write the spider cache')
+        update_spider_cache(lmod_root, modulefiles, enable=False)
 
 
 class Preliminary(Handler):
@@ -112,27 +471,13 @@ class UseCase(Handler):
 
         # INSTALLERS
 
-        # instantiate a connection to Lmod
-        try:
-            lmod_inst = Convey(
-                cache=self.cache,
-                _register_error=register_error)(LmodManager)(**lmod)
-        # defer exceptions
-        except Exception as e:
-            if self._debug:
-                tracebacker(e)
-            pass
-
-        # instantiate a connection to Singularity
-        try:
-            singularity_inst = Convey(cache=self.cache,
-                                      _register_error=register_error
-                                      )(SingularityManager)(**singularity)
-        # defer exceptions
-        except Exception as e:
-            if self._debug:
-                tracebacker(e)
-            pass
+        # detect or build Lmod and Singularity at the same time since they
+        #   do not depend on each other
+        instances = run_managers(self, [
+            ('lmod', LmodManager, lmod),
+            ('singularity', SingularityManager, singularity)])
+        lmod_inst = instances['lmod']
+        singularity_inst = instances['singularity']
 
         # include spack only if requested
         if spack:
@@ -177,10 +522,8 @@ class UseCase(Handler):
             os.path.join(os.path.realpath(singularity_inst.path), 'bin')]
         # infer the version from singularity
         # should this be done with another version checker?
-        result = bash(os.path.join(
-                      singularity_inst.path,
-                      singularity_inst.check_bin_version),
-                      scroll=False)
+        result = probe(self.cache.setdefault('probes', {}), os.path.join(
+            singularity_inst.path, singularity_inst.check_bin_version))
         try:
             version = re.match(r'(?:^|.+\s)(\d+\.\d+(?:\.\d+))',
                                result['stdout']).group(1)
@@ -213,16 +556,8 @@ class UseCase(Handler):
 class VersionCheck(Handler):
     _internals = {'name': '_name', 'meta': 'meta'}
 
-    def _version_check(self, version_this, op, version):
-        return not (
-            (op == '=' and not
-             LooseVersion(version_this) == LooseVersion(version)) or
-            (op == '>' and not
-             LooseVersion(version_this) > LooseVersion(version)) or
-            (op == '>=' and not
-             LooseVersion(version_this) >= LooseVersion(version)))
-
-    def _version_syntax(self, req):
+    @staticmethod
+    def _version_syntax(req):
         regex_version = r'^(=|==|>=|>)?([\d+\.]+)(.*?)$'
         op, version, suffix = None, 0, None
         match = re.match(regex_version, req)
@@ -237,81 +572,37 @@ class VersionCheck(Handler):
             return candidates
         return [line for line in candidates if re.match(regex_semver, line)]
 
-    def _extract_number(self, result):
-        if 'images' in result:
-            # NGC result
-            field = 'tag'
-            list = result['images']
-        else:
-            # Docker API v1
-            field = 'name'
-            list = result
-
-        items = []
-        for i in list:
-            match = re.match(r'^([\d\.]+)(.*?)$', i[field])
-            if match:
-                reduced = match.groups()
-            else:
-                reduced = (i[field],)
-            items.append(reduced)
-        return items
-
-    def _check_version(self, splits, target, prefer_no_suffix=True):
+    def _check_version(self, index, target, prefer_no_suffix=True):
         op, version, suffix = self._version_syntax(target)
-        if op is None:
-            op = "=="
-        candidates = []
-        for split in splits:
-            # the number extracter tries to ignore suffixes i.e. 1.2.3-wheezy
-            this = split[0]
-            # if the user supplied a suffix and we are seeking equality
-            # has a suffix and there is an exact match
-            if suffix and op == "==" and version+suffix == ''.join(split):
-                candidates.append(''.join(split))
-            # no suffix and an exact match (ignores _version_syntax result)
-            elif (not suffix and (len(split) == 1 or not split[1])
-                    and this == target):
-                candidates.append(split[0])
-            # a normal version number without a suffix is checked against
-            #   all other version numbers and prefer_no_suffix determines if
-            #   we allow found suffies to come along
-            elif not suffix and (re.match(r'^[\d\.]+$', this)
-                                 and self._version_check(this, op, version)):
-                # insist on clean version numbers
-                if not prefer_no_suffix or split[1] == '':
-                    candidates.append(''.join(split))
-                else:
-                    pass
-        return candidates
-
-    def docker(self, name, docker_version, prefer_no_suffix=True, semantic_version=None):
+        # unparsed targets like "latest" only match exactly
+        if suffix is None:
+            return [target] if target in index.tags else []
+        # if the user supplied a suffix we only seek an exact match
+        elif suffix:
+            if op in (None, '=', '==') and version+suffix in index.tags:
+                return [version+suffix]
+            return []
+        # a normal version number without a suffix is checked against
+        #   all other version numbers and prefer_no_suffix determines if
+        #   we allow found suffixes to come along
+        return index.select(op or '==', version, clean=prefer_no_suffix)
+
+    def docker(self, name, docker_version, prefer_no_suffix=True,
+               semantic_version=None, tags=None):
         """Check the dockerhub registry."""
-        # import these inside the function because they come with anaconda
-        import urllib
-        import json
-        import urllib.request
-
+        # tags are usually fetched and indexed ahead of time by Execute
+        if tags is None:
+            tags = fetch_tags(name)
+        elif isinstance(tags, Exception):
+            raise tags
+        # NGC tags carry suffixes by design
         if name.startswith('nvcr.io'):
-            # NGC
-            url = "https://api.ngc.nvidia.com/v2/repos/%s/images" % \
-                name.replace('nvcr.io/', '', 1)
             prefer_no_suffix = False
-        else:
-            # Docker Hub
-            url = "https://registry.hub.docker.com/v1/repositories/%s/tags" % \
-                name
-        try:
-            response = urllib.request.urlopen(url)
-        except:  # noqa
-            raise Exception('failed to curl from: %s' % url)
-        result = json.load(response)
-        if not result:
-            print('warning url %s yielded nothing' % url)
-        # we split the version to ignore suffixes
-        splits = self._extract_number(result)
-        # compare the requested version against the splits
-        candidates = self._check_version(splits=splits, target=docker_version,
+        # the index splits each tag once to ignore suffixes
+        if not isinstance(tags, VersionIndex):
+            tags = VersionIndex(tags)
+        # compare the requested version against the index
+        candidates = self._check_version(index=tags, target=docker_version,
                                          prefer_no_suffix=prefer_no_suffix)
         # filter out by semantic version
         if semantic_version is not None:
@@ -348,6 +639,9 @@ class PrepModuleRequest(Handler):
 
 class ModuleRequest(Handler):
     _internals = {'name': '_name', 'meta': 'meta'}
+    # registry tags resolved by Execute are conveyed here by repository
+    tags = {}
+
     @property
     def image_spot(self):
         return self.cache['settings']['images']
@@ -382,9 +676,6 @@ class ModuleRequest(Handler):
         # prepare the spot for the image
         if not source:
             source = self.cache['module_settings']['source']
-        dn = os.path.join(self.cache['case']['modulefiles'], name)
-        if not os.path.isdir(dn):
-            os.mkdir(dn)
         # the modulefile uses the relative path to the conda env for mksquashfs
         conda_env_relpath = os.path.join(os.path.relpath(specs['miniconda']),
                                          'envs', specs['envname'])
@@ -393,7 +684,17 @@ class ModuleRequest(Handler):
         detail = dict(
             image_spot=self.image_spot,
             conda_env=conda_env_relpath,
-            lua_path=lua_path, extras=[])
+            lua_path=lua_path, extras=[],
+            pull_timeout=int(self.cache['module_settings'].get(
+                'pull_timeout', default_modulefile_settings['pull_timeout'])),
+            local_images=self.cache['module_settings'].get(
+                'local_images', default_modulefile_settings['local_images']),
+            local_images_budget=parse_bytes(self.cache['module_settings'].get(
+                'local_images_budget',
+                default_modulefile_settings['local_images_budget'])))
+        # registry digests for each version when the registry provides them
+        digests = {}
+        detail['source_pinned'] = ''
 
         # prepare the source for the pull command
         if source == 'docker':
@@ -402,16 +703,22 @@ class ModuleRequest(Handler):
             # the source will bne suffixed with the tag in the modulefile
             #   this is necessary when using the symlink method
             detail['source'] = 'docker://%s:' % repo_name
+            detail['source_pinned'] = 'docker://%s@' % repo_name
             # note our Handler trick that uses the kwargs
             #   this may seem counterintuitive
             versions = VersionCheck(name=repo_name,
                                     docker_version=version,
-                                    semantic_version=semantic_version).solve
+                                    semantic_version=semantic_version,
+                                    tags=self.tags.get(repo_name)).solve
             if not versions:
                 # better error message
                 raise Exception(('cannot satisfy dockerhub version: '
                                 '%s:%s, versions are: %s') % (
                     repo_name, version, str(versions)))
+            index = self.tags.get(repo_name)
+            if isinstance(index, VersionIndex):
+                digests = dict([(i, index.digests[i]) for i in versions
+                                if i in index.digests])
         elif source == 'shub':
             versions = VersionCheck(shub_version=version).solve
             repo_name = name if not repo else repo
@@ -461,14 +768,46 @@ class ModuleRequest(Handler):
         if gpu:
             detail['extras'].append('add_property("arch","gpu")')
 
-        # write a single hidden base modulefile
-        if versions:
-            if detail.get('extras', None):
-                detail['extras'] = '\n'+'\n'.join(detail['extras'])
-            else:
-                detail['extras'] = ''
-            self._write_modulefile(dn=dn, fn='.base', text=text % detail)
+        # the modulefile stores images with the same digest once
+        detail['digests'] = ', '.join([
+            '["%s"]="%s"' % (k, v) for k, v in sorted(digests.items())])
 
+        # prepare a single hidden base modulefile
+        if detail.get('extras', None):
+            detail['extras'] = '\n'+'\n'.join(detail['extras'])
+        else:
+            detail['extras'] = ''
+        text = text % detail
+
+        # entries are immutable and named by their fingerprint so unchanged
+        #   entries are reused and changed ones are staged in the store
+        #   away from the live tree until Execute publishes them
+        record = dict(
+            fingerprint=self._fingerprint(
+                request=self.kwargs,
+                module_settings=self.cache['module_settings'],
+                sandbox=use_sandbox, versions=list(versions), text=text),
+            source=detail['source'], versions=list(versions),
+            digests=digests)
+        record['entry'] = '%s-%s' % (name, record['fingerprint'][:16])
+        dn = os.path.join(modulefiles_store, 'entries', record['entry'])
+        if not os.path.isdir(dn):
+            self._write_module(dn=dn, text=text, versions=versions)
+        return record
+
+    def _fingerprint(self, **kwargs):
+        """Summarize everything that determines the modulefiles."""
+        return hashlib.sha1(json.dumps(
+            kwargs, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _write_module(self, dn, text, versions):
+        """Write the base modulefile and link each version to it."""
+        # build in a temporary directory so an entry is never half-written
+        dn_temp = '%s.tmp' % dn
+        if os.path.isdir(dn_temp):
+            shutil.rmtree(dn_temp)
+        os.makedirs(dn_temp)
+        self._write_modulefile(dn=dn_temp, fn='.base', text=text)
         # loop over valid versions and create modulefiles
         # +++ assume that we want all tags that satisfy the version
         for tag in versions:
@@ -485,9 +824,10 @@ class ModuleRequest(Handler):
                 Lmod automatically serves the latest available version. this
                 only requires periodic ./cc refresh commands to stay current
             """
-            target_link = os.path.join(dn, modulefile_name+'.lua')
+            target_link = os.path.join(dn_temp, modulefile_name+'.lua')
             if not os.path.isfile(target_link):
                 os.symlink(os.path.join('.base.lua',), target_link)
+        os.rename(dn_temp, dn)
 
 
 class Execute(Handler):
@@ -495,34 +835,74 @@ class Execute(Handler):
     The main execution loop. "Runs" the user setting file.
     Always decorate via: `Execute = Convey(state=state)(Execute)`
     """
-    def _clean_modulefiles(self):
+    def _resolve_tags(self, prepped):
         """
-        Remove all modulefiles except those provided by cc.
+        Fetch the tags for every docker repository on the whitelist
+        concurrently. The pool size is set by resolve_workers and the
+        lifetime of cached registry responses by registry_ttl in the
+        module_settings. Offline refreshes read a snapshot instead.
         """
-        for dn in glob.glob('modulefiles/*'):
-            dn_abs = os.path.realpath(dn)
-            dn_safe = [os.path.realpath('modulefiles/cc')]
-            if dn_abs not in dn_safe:
-                shutil.rmtree(dn)
+        module_settings = self.state['module_settings']
+        repos = docker_repos(prepped, module_settings)
+        # the offline flag holds the path to the snapshot
+        if self.state.get('offline'):
+            tags = read_snapshot(repos, fn=self.state['offline'])
+        # exact versions let the registry queries stop early
+        else:
+            tags = fetch_repos(repos, module_settings,
+                               wanted=exact_tags(prepped, module_settings))
+        # index each repository once even if several entries share it
+        tags = dict([(name, result if isinstance(result, Exception)
+                      else VersionIndex(result))
+                     for name, result in tags.items()])
+        # pin the selected versions to digests. docker hub lists them with the
+        #   tags so we only ask the registry for the rest, or the lockfile
+        #   when we are offline
+        missing = dict([(repo, set([i for i in versions
+                                    if i not in tags[repo].digests]))
+                        for repo, versions in selected_tags(
+                            prepped, module_settings, tags).items()])
+        if self.state.get('offline'):
+            found = read_lockfile()
+        else:
+            found = fetch_repo_digests(missing, module_settings)
+        for repo, versions in missing.items():
+            tags[repo].digests.update(dict([
+                (i, found[repo][i]) for i in versions
+                if i in found.get(repo, {})]))
+        return tags
 
     def whitelist(self, whitelist, images, blacklist=None):
         """
         Handle the whitelist scenario.
         """
-        # clean existing modulefiles in case we are blacklisting
-        self._clean_modulefiles()
-        if blacklist and not isinstance(blacklist, list):
-            raise Exception('the blacklist must be a list: %s' %
-                            str(blacklist))
-        if blacklist:
-            whitelist = dict([(i, j) for i, j in whitelist.items()
-                             if i not in blacklist])
+        whitelist = whitelist_filter(whitelist, blacklist)
         # separate the whitelist from the software settings
         self.whitelist = whitelist
 
-        # build modulefiles for everything on the whitelist
-        for key, val in self.whitelist.items():
-            # preprocess the items
-            prepped = PrepModuleRequest(name=key, detail=val).solve
-            Convey(cache=self.state)(ModuleRequest)(**prepped).solve
+        # preprocess the items
+        prepped = whitelist_requests(self.whitelist)
+        # fetch all registry tags at once before writing any modulefiles
+        tags = self._resolve_tags(prepped)
+
+        # build modulefiles for everything on the whitelist in order
+        # note that unchanged entries are reused by their fingerprints
+        records = {}
+        Request = Convey(cache=self.state, tags=tags)(ModuleRequest)
+        for item in prepped:
+            records[item['name']] = Request(**item).solve
+        # swap the whole tree at once, dropping blacklisted entries
+        changed = publish_modulefiles(
+            self.state['case']['modulefiles'],
+            dict([(name, record['entry'])
+                  for name, record in records.items()]))
+        self.state['modules'] = records
+        write_lockfile(records)
+        # index the tree for Lmod after it changes
+        enable = self.state['module_settings'].get(
+            'spider_cache', default_modulefile_settings['spider_cache'])
+        if changed or not enable or not os.path.isdir(spider_cache):
+            update_spider_cache(self.state['case']['lmod'],
+                                self.state['case']['modulefiles'],
+                                enable=enable)
         print('status community-collections is ready!')
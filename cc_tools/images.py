@@ -0,0 +1,433 @@
+#!/usr/bin/env python
+
+# Python 2/3 compatabilty and color printer
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+Image directory tools for CC.
+Maintains the index of downloaded images which the modulefiles read instead
+of checking for each image separately. The index doubles as a ledger of
+image sizes so that reporting usage never walks the images.
+Images with a registry digest are stored once in a store folder and linked
+to each of their names, and the ledger records the digest for each name.
+"""
+
+import os
+import glob
+import time
+import contextlib
+import shutil
+import subprocess
+
+from .misc import path_resolve
+
+# index of the images present in the images directory and their sizes
+image_index = '.cc_index'
+# log of the time each image is loaded
+image_access = '.cc_access'
+# images named by digest which are linked to their names by pull_image.sh
+image_store = '.store'
+# seconds before a lock on the index is considered stale
+index_lock_timeout = 60
+
+
+def scan_images(dn):
+    """List the images in a directory, skipping hidden files."""
+    if not os.path.isdir(dn):
+        return []
+    return sorted([i for i in os.listdir(dn) if not i.startswith('.')])
+
+
+def read_ledger(dn):
+    """
+    Get the size in bytes and the digest of each image in the index or None
+    if there is no index. Unknown sizes and images without a digest in the
+    store have None for either.
+    """
+    fn = os.path.join(dn, image_index)
+    if not os.path.isfile(fn):
+        return None
+    ledger = {}
+    with open(fn) as fp:
+        for line in fp.read().splitlines():
+            name, size, digest = (line.split('\t') + ['', ''])[:3]
+            if name:
+                ledger[name] = (int(size) if size else None, digest or None)
+    return ledger
+
+
+def read_index(dn):
+    """
+    Get the size in bytes of each image in the index or None if there is no
+    index. Images recorded without a size map to None.
+    """
+    ledger = read_ledger(dn)
+    if ledger is None:
+        return None
+    return dict([(name, size) for name, (size, _) in ledger.items()])
+
+
+def read_digests(dn):
+    """Get the digest in the store for each image in the index."""
+    return dict([(name, digest)
+                 for name, (_, digest) in (read_ledger(dn) or {}).items()
+                 if digest])
+
+
+@contextlib.contextmanager
+def index_lock(dn, timeout=index_lock_timeout):
+    """
+    Lock the index while we read and replace it. This is the same directory
+    lock that post_download.lua takes after a module downloads an image.
+    """
+    lock = os.path.join(dn, '%s.lock' % image_index)
+    waited = 0
+    while True:
+        try:
+            os.mkdir(lock)
+            break
+        except OSError:
+            if not os.path.isdir(lock):
+                raise
+        # locks left by a killed process expire after the timeout
+        try:
+            stale = time.time() - os.path.getmtime(lock) > timeout
+        except OSError:
+            continue
+        if stale:
+            print('warning removing a stale lock: %s' % lock)
+            shutil.rmtree(lock, ignore_errors=True)
+        elif waited >= timeout:
+            raise Exception('timed out waiting for the lock: %s' % lock)
+        else:
+            time.sleep(1)
+            waited += 1
+    try:
+        yield
+    finally:
+        shutil.rmtree(lock, ignore_errors=True)
+
+
+def write_index(dn, sizes, digests=None):
+    """Write the index in one step so that modulefiles never read half."""
+    digests = digests or {}
+    fn = os.path.join(dn, image_index)
+    fn_temp = '%s.tmp.%d' % (fn, os.getpid())
+    with open(fn_temp, 'w') as fp:
+        fp.write(''.join(['\t'.join(
+            [name, '' if size is None else str(size)] +
+            ([digests[name]] if digests.get(name) else [])) + '\n'
+            for name, size in sorted(sizes.items())]))
+    os.rename(fn_temp, fn)
+
+
+def store_digests(dn, names):
+    """
+    Find the digest for images which are hardlinks or symlinks into the
+    store. Digests are written in the store with a hyphen after the hash.
+    """
+    store = os.path.join(dn, image_store)
+    if not os.path.isdir(store):
+        return {}
+    inodes = {}
+    for fn in glob.glob(os.path.join(store, '*.sif')):
+        stat = os.stat(fn)
+        inodes[(stat.st_dev, stat.st_ino)] = os.path.basename(fn)[:-4]
+    digests = {}
+    for name in names:
+        stat = os.stat(os.path.join(dn, name))
+        if (stat.st_dev, stat.st_ino) in inodes:
+            digests[name] = inodes[(stat.st_dev, stat.st_ino)]
+    return digests
+
+
+def usage_total(sizes, digests):
+    """Add up the sizes while counting each image in the store once."""
+    seen = dict([(digests.get(name, name), size or 0)
+                 for name, size in sizes.items()])
+    return sum(seen.values())
+
+
+def prune_store(dn):
+    """Remove images in the store which are no longer linked to a name."""
+    store = os.path.join(dn, image_store)
+    linked = set([os.path.realpath(os.path.join(dn, i))
+                  for i in scan_images(dn)
+                  if os.path.islink(os.path.join(dn, i))])
+    for fn in glob.glob(os.path.join(store, '*.sif')):
+        # sandboxes and images on filesystems without hardlinks are named
+        #   by a symlink, while hardlinked images have more than one link
+        if os.path.realpath(fn) in linked:
+            continue
+        # pull_image.sh holds a lock on the digest until the image is linked
+        elif os.path.isdir('%s.lock' % fn[:-len('.sif')]):
+            continue
+        elif os.path.isdir(fn):
+            shutil.rmtree(fn)
+        elif os.stat(fn).st_nlink == 1:
+            os.remove(fn)
+
+
+def image_size(fn):
+    """Get the size of an image file or sandbox in bytes."""
+    if not os.path.isdir(fn):
+        return os.path.getsize(fn)
+    return sum([os.path.getsize(os.path.join(root, i))
+                for root, dns, fns in os.walk(fn) for i in fns
+                if not os.path.islink(os.path.join(root, i))])
+
+
+def measure_images(dn, names, workers=8):
+    """Measure many images at once since sandboxes have many files."""
+    from concurrent.futures import ThreadPoolExecutor
+    if not names:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        return dict(zip(names, pool.map(
+            lambda name: image_size(os.path.join(dn, name)), names)))
+
+
+def index_images(images, rescan=False, workers=8):
+    """
+    Rebuild the index from the images directory. Sizes in the index are kept
+    for images that are still present unless we rescan all of them.
+    """
+    dn = path_resolve(images)
+    if not os.path.isdir(dn):
+        raise Exception('cannot find the images directory %s' % dn)
+    # skip links to images which were removed from the store
+    names = [i for i in scan_images(dn)
+             if os.path.exists(os.path.join(dn, i))]
+    known = {} if rescan else (read_index(dn) or {})
+    sizes = dict([(i, known[i]) for i in names if known.get(i) is not None])
+    sizes.update(measure_images(
+        dn, [i for i in names if i not in sizes], workers=workers))
+    # measuring can be slow so we only lock the index to replace it
+    with index_lock(dn):
+        # keep the images that modules downloaded while we measured
+        for name, size in (read_index(dn) or {}).items():
+            if name not in sizes and os.path.exists(os.path.join(dn, name)):
+                sizes[name] = size
+        write_index(dn, sizes, digests=store_digests(dn, sorted(sizes)))
+    print('status indexed %d images at %s' % (len(sizes), dn))
+    return sizes
+
+
+def forget_images(dn, names):
+    """Remove deleted images from the index."""
+    with index_lock(dn):
+        sizes, digests = read_index(dn), read_digests(dn)
+        if sizes is None:
+            return
+        for name in names:
+            sizes.pop(name, None)
+        write_index(dn, sizes, digests=digests)
+
+
+def report_usage(images):
+    """Print the size of each image and the total from the index."""
+    dn = path_resolve(images)
+    sizes = read_index(dn)
+    if sizes is None:
+        raise Exception('cannot find an index at %s. '
+                        'Run ./cc images du --rescan.' % dn)
+    for name, size in sorted(sizes.items(), key=lambda i: -(i[1] or 0)):
+        print('%8s %s' % ('?' if size is None else
+                          '%.0fMB' % (size / 1e6), name))
+    digests = read_digests(dn)
+    print('%8s TOTAL at %s' % (
+        '%.0fMB' % (usage_total(sizes, digests) / 1e6), dn))
+    shared = len(digests) - len(set(digests.values()))
+    if shared:
+        print('status %d images share their content with another image' %
+              shared)
+    unknown = [i for i in sizes if sizes[i] is None]
+    if unknown:
+        print('warning the sizes of %d images are unknown. '
+              'Run ./cc images du --rescan.' % len(unknown))
+    return sizes
+
+
+def read_access(dn):
+    """Get the time each image was last loaded from the access log."""
+    fn = os.path.join(dn, image_access)
+    last = {}
+    if not os.path.isfile(fn):
+        return last
+    with open(fn) as fp:
+        for line in fp.read().splitlines():
+            name, _, when = line.partition('\t')
+            if name and when.isdigit():
+                last[name] = max(last.get(name, 0), int(when))
+    return last
+
+
+def compact_access(dn, names):
+    """Rewrite the access log with one line for each remaining image."""
+    last = read_access(dn)
+    fn = os.path.join(dn, image_access)
+    fn_temp = '%s.tmp.%d' % (fn, os.getpid())
+    with open(fn_temp, 'w') as fp:
+        fp.write(''.join(['%s\t%d\n' % (name, last[name])
+                          for name in sorted(names) if name in last]))
+    os.rename(fn_temp, fn)
+
+
+def referenced_images(modulefiles):
+    """
+    List the images named by the versions in the modulefiles tree, which
+    links each version to the base modulefile for its module.
+    """
+    return set(['%s-%s.sif' % (os.path.basename(os.path.dirname(fn)),
+                               os.path.basename(fn)[:-len('.lua')])
+                for fn in glob.glob(os.path.join(modulefiles, '*', '*.lua'))])
+
+
+def collect_images(images, modulefiles, budget=0, dryrun=False):
+    """
+    Delete images that no module refers to, starting with the least recently
+    loaded, until the images fit in the budget in bytes. Without a budget we
+    delete every unreferenced image.
+    """
+    dn = path_resolve(images)
+    if not os.path.isdir(dn):
+        raise Exception('cannot find the images directory %s' % dn)
+    sizes = index_images(dn)
+    digests = read_digests(dn)
+    referenced = referenced_images(modulefiles)
+    last = read_access(dn)
+    # links to images removed from the store have nothing left to collect
+    for name in scan_images(dn):
+        fn = os.path.join(dn, name)
+        if name not in sizes and os.path.islink(fn) and \
+                not os.path.exists(fn):
+            print('status %s the broken link %s' % (
+                'would remove' if dryrun else 'removing', name))
+            if not dryrun:
+                os.remove(fn)
+    # images that were never loaded fall back to their modification time
+    stale = sorted([i for i in sizes if i not in referenced
+                    # skip images removed since we indexed them
+                    and os.path.exists(os.path.join(dn, i))
+                    # skip images that are being downloaded
+                    and not os.path.isdir(os.path.join(dn, '.%s.lock' % i))],
+                   key=lambda i: last.get(i) or os.path.getmtime(
+                       os.path.join(dn, i)))
+    total = usage_total(sizes, digests)
+    removed = []
+    for name in stale:
+        if budget and total <= budget:
+            break
+        # images in the store only free space when their last name is removed
+        digest = digests.get(name)
+        shared = digest and [i for i in sizes if i != name
+                             and i not in removed and digests.get(i) == digest]
+        freed = 0 if shared else sizes[name]
+        print('status %s %s (%.0fMB)' % (
+            'would remove' if dryrun else 'removing', name, freed / 1e6))
+        if not dryrun:
+            fn = os.path.join(dn, name)
+            if os.path.isdir(fn) and not os.path.islink(fn):
+                shutil.rmtree(fn)
+            else:
+                os.remove(fn)
+        total -= freed
+        removed.append(name)
+    if not dryrun and removed:
+        prune_store(dn)
+        forget_images(dn, removed)
+        compact_access(dn, [i for i in sizes if i not in removed])
+    print('status %s %d images, leaving %.0fMB at %s' % (
+        'would remove' if dryrun else 'removed', len(removed),
+        total / 1e6, dn))
+    if budget and total > budget:
+        print('warning the images still exceed the budget of %.0fMB '
+              'because the rest are used by modules' % (budget / 1e6))
+    return removed
+
+
+def prefetch_requests(records, names=None):
+    """
+    List the source and target for each resolved image in the module records
+    using the same naming as the modulefile template.
+    """
+    names = names or sorted(records.keys())
+    missing = [i for i in names if i not in records]
+    if missing:
+        raise Exception('cannot find modules: %s. Check the whitelist and '
+                        'run ./cc refresh.' % ', '.join(missing))
+    requests = []
+    for name in names:
+        for version in records[name]['versions']:
+            digest = records[name].get('digests', {}).get(version, '')
+            # pull pinned versions by digest like the modulefiles
+            requests.append(dict(
+                name=name, digest=digest,
+                source=('%s@%s' % (records[name]['source'][:-1], digest)
+                        if digest else records[name]['source'] + version),
+                target='%s-%s.sif' % (name, version)))
+    return requests
+
+
+def prefetch_images(requests, images, singularity, sandbox=False,
+                    workers=2, bandwidth=0, path_extra=None, timeout=7200):
+    """
+    Pull images in parallel so that loading their modules is instant.
+    Images which are already present are skipped. The bandwidth caps the
+    average download rate in KB/s: each worker pauses after a download until
+    its share of the rate covers the size of the image.
+    Downloads go through the same pull script as the modulefiles so that
+    prefetch never races with a user loading the same module.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    dn = path_resolve(images)
+    if not os.path.isdir(dn):
+        os.makedirs(dn)
+    present = set(scan_images(dn))
+    requests = [i for i in requests if i['target'] not in present]
+    if not requests:
+        print('status all images are present at %s' % dn)
+        return []
+    workers = max(1, min(int(workers), len(requests)))
+    # singularity cannot be slowed down during a pull so we pace the pulls
+    rate = int(bandwidth) * 1e3 / workers
+    pull = 'bash %s %d %%s %%s "%%s" %s %s' % (
+        os.path.join(os.path.dirname(__file__), 'pull_image.sh'),
+        int(timeout), os.path.join(singularity, 'bin', 'singularity'),
+        'build --sandbox' if sandbox else 'pull')
+    env = dict(os.environ)
+    if path_extra:
+        env['PATH'] = '%s:%s' % (env.get('PATH', ''), path_extra)
+
+    def fetch(request):
+        target_fn = os.path.join(dn, request['target'])
+        start = time.time()
+        proc = subprocess.Popen(
+            pull % (
+                target_fn, request['source'], request.get('digest', '')),
+            shell=True, executable='/bin/bash', env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        if proc.returncode != 0 or not os.path.exists(target_fn):
+            print('warning failed to pull %s:\n%s' % (
+                request['source'], output.decode('utf-8', 'replace')))
+            return None
+        size, elapsed = image_size(target_fn), time.time() - start
+        print('status pulled %s (%.0fMB in %.0fs at %.1fMB/s)' % (
+            request['target'], size / 1e6, elapsed,
+            size / 1e6 / max(elapsed, 1e-3)))
+        if rate and size / rate > elapsed:
+            print('status pausing for %.0fs to stay under the prefetch '
+                  'bandwidth' % (size / rate - elapsed))
+            time.sleep(size / rate - elapsed)
+        return request['target']
+
+    print('status prefetching %d images with %d workers' % (
+        len(requests), workers))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pulled = [i for i in pool.map(fetch, requests) if i]
+    # the modulefiles learn about the new images from the index
+    index_images(dn)
+    print('status prefetched %d of %d images' % (len(pulled), len(requests)))
+    return pulled
@@ -14,6 +14,7 @@ import traceback
 from . import stdtools  # noqa
 from .stdtools import Handler
 from .stdtools import command_check
+from .stdtools import probe
 from .stdtools import bash
 # from .stdtools import tracebacker
 
@@ -350,8 +351,9 @@ class LmodManager(Handler):
 
     def _check_lmod(self, path):
         """Confirm the Lmod installation."""
-        check = command_check(
-            self.lmod_bin_check, cwd=path, quiet=True)
+        # the answer is kept in the state until lmod or the PATH changes
+        check = probe(self.cache.setdefault('probes', {}),
+                      self.lmod_bin_check, cwd=path)['returncode']
         return (check == self.lmod_returncode)
 
     def _report_ready(self):
@@ -367,7 +369,8 @@ class LmodManager(Handler):
         # pass the custom lua location if necessary
         if hasattr(self, 'lua'):
             self.cache['settings']['lmod']['lua'] = self.lua
-        # lmod also includes updates to LMODRC
+        # lmod also includes updates to LMODRC for our properties and for
+        #   the spider cache which lists the modulefiles without reading them
         # note that we use the keyed nature of profile_mods to overwrite
         #   any similar changes to the profile
         lmodrc_fn = \
@@ -567,7 +570,8 @@ class SingularityManager(Handler):
     check_bin = 'bin/singularity help'
     check_bin_version = 'bin/singularity --version'
     check_returncode = 0
-    user_namespace_check = 'cat /proc/sys/user/max_user_namespaces'
+    user_namespace_fn = '/proc/sys/user/max_user_namespaces'
+    user_namespace_check = 'cat %s' % user_namespace_fn
     default_build_conf = {'build': './singularity', 'sandbox': False}
     ERROR_USER_NAMESPACES = ((
         'The sandbox flag in the Singularity settings '
@@ -577,11 +581,9 @@ class SingularityManager(Handler):
         (cc_user, user_namespace_check))
 
     def _detect_singularity(self):
-        try:
-            which_singularity = bash(
-                'which singularity', scroll=False, quiet=True)
-        # error code on which causes an exception
-        except:
+        which_singularity = probe(
+            self.cache.setdefault('probes', {}), 'which singularity')
+        if which_singularity['returncode'] != 0:
             return False
         fn = which_singularity['stdout'].strip()
         if os.path.isfile(fn):
@@ -617,9 +619,9 @@ class SingularityManager(Handler):
 
     def _check_singularity(self, path):
         print('status checking singularity')
-        return (command_check(
-            self.check_bin,
-            cwd=path, quiet=True) == self.check_returncode)
+        return (probe(
+            self.cache.setdefault('probes', {}),
+            self.check_bin, cwd=path)['returncode'] == self.check_returncode)
 
     def _report_ready(self, built=False):
         print('status Singularity is reporting ready')
@@ -657,13 +659,15 @@ class SingularityManager(Handler):
         self.path = path
 
     def _check_user_namespaces(self):
+        # read the kernel setting directly instead of starting a shell
         try:
-            result = bash(self.user_namespace_check, scroll=False)
+            with open(self.user_namespace_fn) as fp:
+                result = fp.read()
         except Exception as e:
             print('error %s' % str(e))
             raise Exception(self.ERROR_USER_NAMESPACES)
         try:
-            max_user_ns = int(result['stdout'].strip())
+            max_user_ns = int(result.strip())
         except Exception as e:
             print('error %s' % str(e))
             raise Exception(self.ERROR_USER_NAMESPACES)
@@ -8,3 +8,14 @@ propT = {
      },
    },
 }
+
+-- spider cache written by ./cc refresh for the community collections tree
+local cc_root = os.getenv("_COMCOL_ROOT")
+if cc_root then
+   scDescriptT = {
+      {
+         dir       = cc_root .. "/spider_cache",
+         timestamp = cc_root .. "/spider_cache/timestamp",
+      },
+   }
+end
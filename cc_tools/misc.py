@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import os
+import re
 import sys
 import copy
 import tempfile
@@ -9,6 +10,7 @@ from .settings import specs
 from .settings import default_bootstrap
 from .stdtools import bash
 from .stdtools import tracebacker
+from .stdtools import lock_file
 from .settings import default_full  # for settings_resolver
 
 
@@ -21,6 +23,19 @@ def path_resolve(path):
     return os.path.realpath(os.path.expanduser(path))
 
 
+def parse_bytes(size):
+    """
+    Convert a size like 500M or 20G into bytes using powers of 1024.
+    Numbers without a unit are bytes.
+    """
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)i?b?\s*$',
+                     str(size).lower())
+    if not match:
+        raise Exception('cannot understand the size: %s' % size)
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' kmgt'.index(unit or ' '))
+
+
 def kickstart_yaml():
     """Start with the default user settings if absent."""
     if not os.path.isfile(cc_user):
@@ -35,10 +50,28 @@ def kickstart_yaml():
     return settings
 
 
+def read_user_yaml():
+    import yaml
+    lock = lock_file(cc_user, shared=True)
+    try:
+        with open(cc_user) as fp:
+            return yaml.load(fp, Loader=yaml.SafeLoader)
+    finally:
+        lock.close()
+
+
 def write_user_yaml(data):
     import yaml
-    with open(cc_user, 'w') as fp:
-        yaml.dump(data, fp)
+    lock = lock_file(cc_user)
+    try:
+        # readers never see a partial file
+        fn_temp = '%s.tmp' % cc_user
+        with open(fn_temp, 'w') as fp:
+            # copy the tracked containers from the state into plain ones
+            yaml.dump(copy.deepcopy(data), fp)
+        os.rename(fn_temp, cc_user)
+    finally:
+        lock.close()
 
 
 def cache_closer(self):
@@ -49,6 +82,8 @@ def cache_closer(self):
     for key in ['settings', 'settings_raw']:
         if key in self.cache:
             del self.cache[key]
+    # the offline flag only applies to a single refresh
+    self.cache.pop('offline', None)
 
 
 # use a subshell command to run commands in conda before completing the
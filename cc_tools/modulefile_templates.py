@@ -4,8 +4,15 @@ modulefile_basic_base = """
 -- this file is generated by cc_tools/modulefile_templates.py
 
 local images_dn = "%%(image_spot)s"
+-- images with the same registry digest are downloaded and stored once
+local digests = {%%(digests)s}
+local digest = digests[myModuleVersion()] or ""
 -- the source is suffixed with the tag, which is identical to the Lmod version
+--   unless refresh pinned the tag to the digest of its content
 local source = "%%(source)s" .. myModuleVersion()
+if digest ~= "" then
+    source = "%%(source_pinned)s" .. digest
+end
 local conda_env = "%%(conda_env)s"
 local target = myModuleName() .. "-" .. myModuleVersion() .. ".sif"
 
@@ -18,7 +25,40 @@ end
 local images_dn_abs = resolve_tilde(images_dn)
 local target_fn = pathJoin(images_dn_abs,target)
 
-if lfs.attributes(target_fn) then
+-- the shell functions run a node-local copy of the image if requested
+local image_fn = target_fn
+local local_dn = "%%(local_images)s"
+if local_dn ~= "" then
+    image_fn = ('"$(bash ' ..
+        pathJoin(os.getenv("_COMCOL_ROOT"),"cc_tools","stage_image.sh") ..
+        " " .. local_dn .. " %%(local_images_budget)s " .. target_fn .. ')"')
+end
+
+-- read the index of downloaded images once per Lmod invocation since every
+--   modulefile shares these globals. without an index we list the directory
+function cc_images_present(dn)
+    cc_images_index = cc_images_index or {}
+    if cc_images_index[dn]==nil then
+        local present = {}
+        local fp = io.open(pathJoin(dn,".cc_index"),"r")
+        if fp then
+            for line in fp:lines() do
+                present[line:match("^[^\\t]*")] = true
+            end
+            fp:close()
+        elseif lfs.attributes(dn,'mode')=="directory" then
+            for path in lfs.dir(dn) do
+                present[path] = true
+            end
+        end
+        cc_images_index[dn] = present
+    end
+    return cc_images_index[dn]
+end
+
+-- skip the image check when cc writes the spider cache for all users
+if os.getenv("_COMCOL_SPIDER_CACHE") then
+elseif cc_images_present(images_dn_abs)[target] then
     add_property("cc_status","ready")
 else
     add_property("cc_status","available")
@@ -26,23 +66,26 @@ end
 %%(extras)s
 if mode()=="load" then
 
-    -- make a cache directory
-    if lfs.attributes(images_dn_abs,'mode')==nil then
-        io.stderr:write(
-            "[CC] making a cache directory: " .. images_dn_abs .. "\\n")
-        lfs.mkdir(images_dn_abs)
+    -- record the load so that ./cc images gc removes the least recent images
+    local access = io.open(pathJoin(images_dn_abs,".cc_access"),"a")
+    if access then
+        access:write(target .. "\\t" .. os.time() .. "\\n")
+        access:close()
     end
-    -- download the image
+    -- download the image if necessary. the pull script makes sure that only
+    --   one process downloads it while any others wait for the image
     if lfs.attributes(target_fn,'mode')==nil then
         local conda_bin = pathJoin(os.getenv("_COMCOL_ROOT"),conda_env,"bin")
         local prefix = "PATH=$PATH:" .. conda_bin .. " "
         -- after download we report on the size
         local suffix = (" && %%(lua_path)s " ..
             pathJoin(os.getenv("_COMCOL_ROOT"),"cc_tools","post_download.lua")
-            .. " " .. images_dn .. " " .. target_fn .. " " .. myModuleName())
-        local cmd = (prefix ..
-            "%(singularity_pull)s " .. target_fn .. " " ..
-            source .. suffix)
+            .. " " .. images_dn .. " " .. target_fn .. " " .. myModuleName()
+            .. ' "' .. digest .. '"')
+        local cmd = (prefix .. "bash " ..
+            pathJoin(os.getenv("_COMCOL_ROOT"),"cc_tools","pull_image.sh")
+            .. " %%(pull_timeout)s " .. target_fn .. " " .. source ..
+            ' "' .. digest .. '"' .. " %(singularity_pull)s" .. suffix)
         execute{cmd=cmd,modeA={"load"}}
     end
     -- interface to the container
@@ -58,11 +101,11 @@ modulefile_sandbox = modulefile_basic_base % dict(
     singularity_pull='singularity build --sandbox')
 
 shell_connection_exec = """    set_shell_function('%(alias)s',
-        "singularity exec %(flags)s" .. target_fn .. ' %(target)s "$@"',
-        "singularity exec %(flags)s" .. target_fn .. '%(target)s "$*"')
+        "singularity exec %(flags)s" .. image_fn .. ' %(target)s "$@"',
+        "singularity exec %(flags)s" .. image_fn .. '%(target)s "$*"')
 """
 
 shell_connection_run = """    set_shell_function('%(alias)s',
-        "singularity run %(flags)s" .. target_fn,
-        "singularity run %(flags)s" .. target_fn)
+        "singularity run %(flags)s" .. image_fn,
+        "singularity run %(flags)s" .. image_fn)
 """
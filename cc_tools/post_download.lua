@@ -2,13 +2,15 @@ require 'io'
 require 'lfs'
 
 -- POSTSCRIPT for an image download
--- This script runs after an image is downloaded
--- to tell the user the size of their cache directory
--- arguments are: the image directory, the downloaded file, and the module name
+-- This script runs after an image is downloaded to record its size
+-- and tell the user the size of their cache directory
+-- arguments are: the image directory, the downloaded file, the module name,
+--   and the registry digest, which is empty unless the image is in the store
 
 local images_dn_abs = arg[1]
 local target_fn = arg[2]
 local my_module_name = arg[3]
+local digest = string.gsub(arg[4] or "", ":", "-")
 
 function isDir(name)
     -- via https://stackoverflow.com/a/21637668/3313859
@@ -30,53 +32,126 @@ function os.capture(cmd, raw)
     return s
 end
 
-function check_image_sizes() 
-    io.stderr:write("[CC] checking image sizes at " .. images_dn_abs .. "\n")
-    total_size = 0
-    has_sandboxes = false
-    for path in lfs.dir(images_dn_abs) do
-        -- better way to select only files?
-        if path ~= "." and path ~= ".." then
-            if isDir(images_dn_abs .. "/" .. path) then
-                local result_du = os.capture(
-                    "du -s " .. images_dn_abs .. "/" .. path)
-                local size = tonumber(string.match(result_du,'^%d+'))
-                total_size = total_size + size/1024
-                local size_str = string.format("%6.0fMB",size/1024)
-                io.stderr:write(size_str .. " " .. path .. "\n")
-                has_sandboxes = true
-            else
-                -- pathJoin is not available outside lmod
-                local size = tonumber(lfs.attributes(
-                    images_dn_abs .. "/" .. path, "size"))
-                total_size = total_size + size/1000000
-                local size_str = string.format("%6.0fMB",size/1000000)
-                io.stderr:write(size_str .. " " .. path .. "\n")
+function image_size(path)
+    -- measure only the new image since sandboxes have many files
+    if isDir(path) then
+        return tonumber(string.match(os.capture("du -sb " .. path), '^%d+'))
+    end
+    return tonumber(lfs.attributes(path, "size"))
+end
+
+function with_lock(lock, timeout, action)
+    -- take the same kind of lock as pull_image.sh, a directory which only
+    --   one process can make, so that writers never lose each other's work
+    -- locks left by a killed process expire after the timeout
+    local waited = 0
+    while not lfs.mkdir(lock) do
+        local made = lfs.attributes(lock, "modification")
+        if made and os.time() - made > timeout then
+            io.stderr:write("[CC] removing a stale lock: " .. lock .. "\n")
+            lfs.rmdir(lock)
+        elseif waited >= timeout then
+            error("timed out waiting for the lock: " .. lock)
+        else
+            os.execute("sleep 1")
+            waited = waited + 1
+        end
+    end
+    local ok, sizes, digests, target = pcall(action)
+    lfs.rmdir(lock)
+    if not ok then
+        error(sizes)
+    end
+    return sizes, digests, target
+end
+
+function update_ledger()
+    -- add the image to the index read by the modulefiles, which also
+    --   records the size of each image so that we never walk the images
+    local index_fn = images_dn_abs .. "/.cc_index"
+    local sizes = {}
+    local digests = {}
+    local fp = io.open(index_fn, "r")
+    if fp then
+        for line in fp:lines() do
+            local name, size, key = string.match(line,
+                "^([^\t]+)\t?(%d*)\t?([^\t]*)$")
+            if name then
+                sizes[name] = tonumber(size) or false
+                if key ~= "" then
+                    digests[name] = key
+                end
+            end
+        end
+        fp:close()
+    else
+        -- start a new index with the images already in the directory
+        --   where ./cc images du --rescan can measure any sandboxes
+        for path in lfs.dir(images_dn_abs) do
+            if string.sub(path, 1, 1) ~= "." then
+                local full = images_dn_abs .. "/" .. path
+                sizes[path] = (not isDir(full) and
+                    tonumber(lfs.attributes(full, "size"))) or false
             end
         end
     end
-    local size_str = string.format("%6.0fMB TOTAL",total_size)
-    io.stderr:write(size_str .. "\n")
-    if has_sandboxes then 
-        io.stderr:write("[CC] note that your image folder contains " ..
-            "sandboxes\n[CC] and sandboxes often have many files!" .. "\n")
+    local target = string.match(target_fn, "[^/]+$")
+    sizes[target] = image_size(target_fn) or false
+    if digest ~= "" then
+        digests[target] = digest
     end
-    -- run du on the singularity folder as a warning
-    if isDir(os.getenv("HOME") .. "/" .. ".singularity") then
-        local result_du = os.capture(
-            "du -s " .. os.getenv("HOME") .. "/" .. ".singularity")
-        local size = tonumber(string.match(result_du,'^%d+'))
-        if size>16 then
-            total_size = total_size + size/1024
-            io.stderr:write(string.format(
-                "[CC] the ~/.singularity folder is also %.0fMB\n",size/1024))
-            io.stderr:write("[CC] you can clear the singularity cache with: " ..
-                "\"singularity cache clean -f\"" .. "\n")
+    local lines = {}
+    for name, size in pairs(sizes) do
+        table.insert(lines, name .. "\t" ..
+            (size and string.format("%d", size) or "") ..
+            (digests[name] and ("\t" .. digests[name]) or ""))
+    end
+    table.sort(lines)
+    -- replace the index in one step so the modulefiles never read half
+    -- the temporary file is named for this host and process
+    local index_fn_temp = index_fn .. ".tmp." ..
+        os.capture("echo $(hostname).$PPID")
+    fp = assert(io.open(index_fn_temp, "w"))
+    fp:write(table.concat(lines, "\n") .. "\n")
+    fp:close()
+    os.rename(index_fn_temp, index_fn)
+    return sizes, digests, target
+end
+
+function report_image_sizes(sizes, digests, target)
+    -- report usage from the ledger instead of measuring every image
+    --   where images in the store are counted once
+    local total_size = 0
+    local unknown = 0
+    local seen = {}
+    for name, size in pairs(sizes) do
+        local key = digests[name] or name
+        if not size then
+            unknown = unknown + 1
+        elseif not seen[key] then
+            total_size = total_size + size
         end
+        seen[key] = true
+    end
+    if sizes[target] then
+        io.stderr:write(string.format("%6.0fMB %s\n",
+            sizes[target]/1000000, target))
+    end
+    io.stderr:write(string.format("%6.0fMB TOTAL at %s\n",
+        total_size/1000000, images_dn_abs))
+    if unknown > 0 then
+        io.stderr:write("[CC] the sizes of " .. unknown .. " images are " ..
+            "unknown: run ./cc images du --rescan\n")
+    end
+    -- the singularity cache also counts against the quota
+    if isDir(os.getenv("HOME") .. "/" .. ".singularity/cache") then
+        io.stderr:write("[CC] you can clear the singularity cache with: " ..
+            "\"singularity cache clean -f\"" .. "\n")
     end
 end
 
 io.stderr:write("[CC] downloaded the image: " .. target_fn .. "\n")
-check_image_sizes()
+report_image_sizes(with_lock(images_dn_abs .. "/.cc_index.lock", 60,
+    update_ledger))
 io.stderr:write("[CC] please be mindful of your quota\n")
 io.stderr:write("[CC] the module is ready: " .. my_module_name .. "\n")
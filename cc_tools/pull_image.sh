@@ -0,0 +1,108 @@
+#!/bin/bash
+
+# SINGLE-FLIGHT IMAGE DOWNLOAD
+# The modulefiles and ./cc prefetch call this script to download an image.
+# The first caller takes a lock next to the image, pulls to a hidden
+#   temporary name, and renames it into place. Everyone else waits for the
+#   lock and then uses the image instead of downloading it again.
+# Images with a registry digest are stored once in the .store folder of the
+#   images directory and linked to each name, so the lock is on the digest.
+# usage: pull_image.sh <timeout> <target> <source> <digest> <pull command ...>
+
+timeout="$1"
+target="$2"
+source="$3"
+digest="$4"
+shift 4
+dn="$(dirname "$target")"
+if [ -n "$digest" ]; then
+    store="$dn/.store"
+    key="${digest//:/-}"
+    stored="$store/$key.sif"
+    mkdir -p "$store" || exit 1
+else
+    store="$dn"
+    key=".$(basename "$target")"
+fi
+lock="$store/$key.lock"
+temp="$store/$key.tmp.$$"
+
+link_stored() {
+    # hardlinks keep the image when the name is removed while sandboxes
+    #   are directories which can only be linked symbolically
+    ln "$stored" "$target" 2>/dev/null ||
+        ln -s ".store/$(basename "$stored")" "$target"
+}
+
+# the owner refreshes the lock while it downloads, so a lock which has not
+#   been refreshed for a minute, or whose owner on this host has exited,
+#   was left by a download that was killed
+heartbeat=10
+stale_age=60
+host="$(hostname)"
+
+lock_stale() {
+    local owner age
+    owner="$(cat "$lock/owner" 2>/dev/null)"
+    age=$(( $(date +%s) - $(stat -c %Y "$lock" 2>/dev/null || date +%s) ))
+    if [ "$age" -gt "$stale_age" ]; then
+        return 0
+    fi
+    [ "${owner%%:*}" == "$host" ] && ! kill -0 "${owner##*:}" 2>/dev/null
+}
+
+clear_stale() {
+    # move the lock aside first so that only one caller removes it
+    local owner="$(cat "$lock/owner" 2>/dev/null)"
+    mv "$lock" "$lock.stale.$$" 2>/dev/null || return
+    # put back a lock that someone took after we found the stale one
+    if [ "$(cat "$lock.stale.$$/owner" 2>/dev/null)" != "$owner" ]; then
+        [ -e "$lock" ] || mv "$lock.stale.$$" "$lock" 2>/dev/null
+        return
+    fi
+    echo "[CC] removing a stale lock from $owner" >&2
+    rm -rf "$lock.stale.$$"
+}
+
+mkdir -p "$dn" || exit 1
+waited=0
+while ! mkdir "$lock" 2>/dev/null; do
+    if lock_stale; then
+        clear_stale
+        continue
+    fi
+    if [ "$waited" -ge "$timeout" ]; then
+        echo "[CC] timed out after ${waited}s waiting for the download of" \
+            "$(basename "$target") by $(cat "$lock/owner" 2>/dev/null)" >&2
+        echo "[CC] remove $lock if that download has stopped" >&2
+        exit 1
+    fi
+    if [ $((waited % 30)) -eq 0 ]; then
+        echo "[CC] waiting ${waited}s for $(cat "$lock/owner" 2>/dev/null)" \
+            "to download $(basename "$target")" \
+            "($(du -sm "$store/$key.tmp."* 2>/dev/null | \
+            awk '{s+=$1} END {print s+0}')MB so far)" >&2
+    fi
+    sleep 5
+    waited=$((waited + 5))
+done
+echo "$host:$$" > "$lock/owner"
+# refresh the lock until we exit, even if we are killed
+( while sleep "$heartbeat" && kill -0 $$ 2>/dev/null; do
+    touch -c "$lock"
+done ) >/dev/null 2>&1 &
+beat=$!
+trap 'kill $beat 2>/dev/null; rm -rf "$lock" "$temp"' EXIT
+
+# another caller may have finished while we waited
+if [ -e "$target" ]; then
+    exit 0
+fi
+if [ -z "$digest" ]; then
+    "$@" "$temp" "$source" && mv "$temp" "$target"
+elif [ -e "$stored" ]; then
+    echo "[CC] found identical content for $(basename "$target")" >&2
+    link_stored
+else
+    "$@" "$temp" "$source" && mv "$temp" "$stored" && link_stored
+fi
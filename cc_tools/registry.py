@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+
+# Python 2/3 compatabilty and color printer
+from __future__ import print_function
+from __future__ import unicode_literals
+
+"""
+Registry queries for CC.
+Collects the tag lists which VersionCheck compares against the whitelist.
+"""
+
+import os
+import re
+import json
+import time
+import bisect
+import threading
+
+
+# largest page of tags served by the Docker Hub API
+page_size = 100
+
+# manifest types which we accept when asking the registry for a digest
+manifest_types = ', '.join([
+    'application/vnd.docker.distribution.manifest.list.v2+json',
+    'application/vnd.docker.distribution.manifest.v2+json',
+    'application/vnd.oci.image.index.v1+json',
+    'application/vnd.oci.image.manifest.v1+json'])
+
+
+def registry_url(name):
+    """Get the URL for the first page of tags for a repository."""
+    if name.startswith('nvcr.io'):
+        # NGC
+        return "https://api.ngc.nvidia.com/v2/repos/%s/images" % \
+            name.replace('nvcr.io/', '', 1)
+    else:
+        # Docker Hub v2 pages through tags and keeps official images in library
+        repo = name if '/' in name else 'library/%s' % name
+        return ("https://hub.docker.com/v2/repositories/%s/tags"
+                "?page_size=%d" % (repo, page_size))
+
+
+def manifest_urls(name):
+    """Get the manifest and anonymous token URLs for a repository."""
+    if name.startswith('nvcr.io'):
+        repo = name.replace('nvcr.io/', '', 1)
+        return ('https://nvcr.io/v2/%s/manifests/' % repo,
+                'https://nvcr.io/proxy_auth?scope=repository:%s:pull' % repo)
+    else:
+        repo = name if '/' in name else 'library/%s' % name
+        return ('https://registry-1.docker.io/v2/%s/manifests/' % repo,
+                'https://auth.docker.io/token?service=registry.docker.io'
+                '&scope=repository:%s:pull' % repo)
+
+
+def parse_page(result):
+    """
+    Reduce one page of a registry response to a dictionary from each tag to
+    its digest (or None when the registry omits it) and the next page.
+    """
+    if 'images' in result:
+        # NGC result in a single page
+        return dict([(i['tag'], i.get('digest'))
+                     for i in result['images']]), None
+    else:
+        # Docker Hub API v2
+        return dict([(i['name'], i.get('digest'))
+                     for i in result['results']]), result.get('next')
+
+
+def version_key(number):
+    """Convert a version number like 3.6.1 into a sortable tuple."""
+    return tuple(int(i) for i in re.findall(r'\d+', number))
+
+
+class VersionIndex(object):
+    """
+    Parsed and sorted view of the tags in one repository.
+    Each tag is split once into a version number and a suffix, and numbers
+    become integer tuples so that version queries are bisections.
+    Tags may be a dictionary from each tag to its digest.
+    """
+    def __init__(self, tags):
+        self.tags = set(tags)
+        self.digests = dict([(k, v) for k, v in tags.items() if v]
+                            if isinstance(tags, dict) else [])
+        # numbered holds every numeric tag while clean omits suffixed tags
+        numbered = []
+        for tag in self.tags:
+            match = re.match(r'^([\d\.]+)(.*?)$', tag)
+            if match:
+                number, suffix = match.groups()
+                numbered.append((version_key(number), bool(suffix), tag))
+        self.numbered = sorted(numbered)
+        self.numbered_keys = [i[0] for i in self.numbered]
+        self.clean = [i for i in self.numbered if not i[1]]
+        self.clean_keys = [i[0] for i in self.clean]
+
+    def select(self, op, version, clean=True):
+        """
+        Get tags whose version number satisfies the operator in version
+        order. Suffixed tags are included only when clean is False.
+        """
+        entries, keys = ((self.clean, self.clean_keys) if clean else
+                         (self.numbered, self.numbered_keys))
+        key = version_key(version)
+        if op == '>=':
+            lo, hi = bisect.bisect_left(keys, key), len(keys)
+        elif op == '>':
+            lo, hi = bisect.bisect_right(keys, key), len(keys)
+        elif op in ('=', '=='):
+            lo, hi = (bisect.bisect_left(keys, key),
+                      bisect.bisect_right(keys, key))
+        else:
+            raise Exception('invalid version operator: %s' % op)
+        return [i[2] for i in entries[lo:hi]]
+
+
+class TagCache(object):
+    """
+    On-disk cache of registry tag lists keyed by repository.
+    Entries younger than the ttl (in seconds) are served directly while older
+    entries are revalidated with a conditional request using the ETag and
+    Last-Modified validators from the previous response.
+    """
+    def __init__(self, fn='registry.json', ttl=3600):
+        self.fn = fn
+        self.ttl = ttl
+        self.entries = {}
+        self.changed = False
+        self.lock = threading.Lock()
+        if os.path.isfile(self.fn):
+            try:
+                with open(self.fn) as fp:
+                    self.entries = json.load(fp)
+            except ValueError:
+                print('warning ignoring unreadable registry cache %s' %
+                      self.fn)
+
+    def lookup(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def fresh(self, entry):
+        return time.time() - entry['when'] < self.ttl
+
+    def store(self, name, tags=None, etag=None, last_modified=None,
+              partial=False):
+        """
+        Save a new response or renew an entry that was not modified.
+        Partial entries hold only the exact tags that a request wanted.
+        """
+        with self.lock:
+            if tags is None:
+                entry = self.entries[name]
+            else:
+                # digests are stored apart from the tags to keep their order
+                entry = dict(tags=list(tags), etag=etag,
+                             digests=dict([(k, v) for k, v in tags.items()
+                                           if v]),
+                             last_modified=last_modified, partial=partial)
+            entry['when'] = time.time()
+            self.entries[name] = entry
+            self.changed = True
+
+    def store_digests(self, name, digests):
+        """Add digests found later to the tags in an existing entry."""
+        with self.lock:
+            if name in self.entries and digests:
+                self.entries[name].setdefault('digests', {}).update(digests)
+                self.changed = True
+
+    def write(self):
+        if not self.changed:
+            return
+        # write to a temporary file so readers never see a partial cache
+        fn_temp = '%s.tmp' % self.fn
+        with open(fn_temp, 'w') as fp:
+            json.dump(self.entries, fp)
+        os.rename(fn_temp, self.fn)
+        self.changed = False
+
+
+def cached_tags(entry):
+    """Get the tags and digests from a cache entry."""
+    digests = entry.get('digests', {})
+    return dict([(i, digests.get(i)) for i in entry['tags']])
+
+
+def fetch_tags(name, cache=None, wanted=None):
+    """
+    Download the tags for a repository one page at a time and return a
+    dictionary from each tag to its digest. When wanted holds the exact tags
+    we are looking for, we keep only those from each page and stop paging as
+    soon as all of them have appeared. These partial lists are cached apart
+    from full lists and serve later requests for the same tags.
+    """
+    # import these inside the function because they come with anaconda
+    import urllib
+    import urllib.error
+    import urllib.request
+    entry = cache.lookup(name) if cache else None
+    # partial entries only answer requests for the tags they hold
+    if entry and entry.get('partial') and not (
+            wanted and set(wanted).issubset(entry['tags'])):
+        entry = None
+    if entry and cache.fresh(entry):
+        return cached_tags(entry)
+    missing = set(wanted) if wanted else None
+    url = registry_url(name)
+    tags, validators, first = {}, {}, True
+    while url:
+        request = urllib.request.Request(url)
+        # revalidate a stale entry so an unchanged list costs a 304. the
+        #   first page is sorted by last update so it changes with any tag
+        if entry and first and entry.get('etag'):
+            request.add_header('If-None-Match', entry['etag'])
+        if entry and first and entry.get('last_modified'):
+            request.add_header('If-Modified-Since', entry['last_modified'])
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304 and entry and first:
+                cache.store(name)
+                return cached_tags(entry)
+            raise Exception('failed to curl from: %s' % url)
+        except:  # noqa
+            raise Exception('failed to curl from: %s' % url)
+        if first:
+            validators = dict(
+                etag=response.headers.get('ETag'),
+                last_modified=response.headers.get('Last-Modified'))
+            first = False
+        page, url = parse_page(json.load(response))
+        if missing is None:
+            tags.update(page)
+            continue
+        # memory stays bounded by the page size when we know the tags
+        tags.update([(k, v) for k, v in page.items() if k in wanted])
+        missing.difference_update(page)
+        if not missing:
+            break
+    if not tags:
+        print('warning %s yielded no tags' % registry_url(name))
+    if cache:
+        cache.store(name, tags=tags, partial=missing is not None,
+                    **validators)
+    return tags
+
+
+def resolve_tags(names, workers=8, cache=None, wanted=None):
+    """
+    Fetch the tag lists for many repositories at once.
+    Returns a dictionary from each name to its tags, or to the exception
+    raised while fetching them so the caller can report it in order.
+    The optional wanted dictionary maps names to exact tags for fetch_tags.
+    """
+    wanted = wanted or {}
+    from concurrent.futures import ThreadPoolExecutor
+    # repositories shared by several whitelist entries are fetched once
+    names = list(dict([(i, None) for i in names]).keys())
+    if not names:
+        return {}
+
+    def fetch(name):
+        try:
+            return fetch_tags(name, cache=cache, wanted=wanted.get(name))
+        except Exception as e:
+            return e
+
+    print('status fetching tags for %d repositories' % len(names))
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        return dict(zip(names, pool.map(fetch, names)))
+
+
+def fetch_digests(name, tags):
+    """
+    Ask the registry for the manifest digest of each tag with a HEAD request
+    using one anonymous pull token for the repository.
+    """
+    # import these inside the function because they come with anaconda
+    import urllib.request
+    url, auth = manifest_urls(name)
+    try:
+        token = json.load(urllib.request.urlopen(auth))
+    except:  # noqa
+        raise Exception('failed to get a token from: %s' % auth)
+    digests = {}
+    for tag in tags:
+        request = urllib.request.Request(url + tag, method='HEAD')
+        request.add_header('Accept', manifest_types)
+        request.add_header('Authorization', 'Bearer %s' % (
+            token.get('token') or token.get('access_token')))
+        try:
+            response = urllib.request.urlopen(request)
+        except:  # noqa
+            raise Exception('failed to get the digest from: %s' % (url + tag))
+        digests[tag] = response.headers.get('Docker-Content-Digest')
+    return dict([(k, v) for k, v in digests.items() if v])
+
+
+def resolve_digests(wanted, workers=8):
+    """
+    Fetch the digests for the tags selected in many repositories at once.
+    The wanted dictionary maps each repository to its tags. Returns a
+    dictionary from each repository to its digests or to an exception.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    wanted = dict([(k, v) for k, v in wanted.items() if v])
+    if not wanted:
+        return {}
+
+    def fetch(name):
+        try:
+            return fetch_digests(name, sorted(wanted[name]))
+        except Exception as e:
+            return e
+
+    names = sorted(wanted.keys())
+    print('status fetching digests for %d repositories' % len(names))
+    with ThreadPoolExecutor(max_workers=max(1, int(workers))) as pool:
+        return dict(zip(names, pool.map(fetch, names)))
+
+
+def write_snapshot(tags, fn='tags_snapshot.json'):
+    """Save tag lists to a single compact file for offline refreshes."""
+    snapshot = dict(when=time.time(), tags=tags)
+    fn_temp = '%s.tmp' % fn
+    with open(fn_temp, 'w') as fp:
+        json.dump(snapshot, fp, separators=(',', ':'), sort_keys=True)
+    os.rename(fn_temp, fn)
+
+
+def read_snapshot(names, fn='tags_snapshot.json'):
+    """
+    Resolve tag lists from a snapshot without touching the network.
+    Missing repositories map to exceptions in the style of resolve_tags.
+    """
+    if not os.path.isfile(fn):
+        raise Exception('cannot find the tag snapshot %s. '
+                        'Run ./cc snapshot-tags on a networked host.' % fn)
+    with open(fn) as fp:
+        snapshot = json.load(fp)['tags']
+    print('status resolving tags offline from %s' % fn)
+    return dict([(name, snapshot[name] if name in snapshot else Exception(
+        'cannot find %s in the tag snapshot %s' % (name, fn)))
+        for name in names])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Run shell commands on an asyncio event loop.
+Many commands can run at once. Output streams to the screen line by line
+with an optional tag for each command, every command can have a wall-clock
+timeout, and each result carries the return code and the output.
+This module requires Python 3.8, where new event loops can watch child
+processes from any thread, and stdtools only imports it there.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import os
+import re
+import sys
+import signal
+import asyncio
+
+from .stdtools import shell_free
+from .stdtools import output_tags
+
+# the return code for commands that cannot be found, as in bash
+returncode_missing = 127
+# the return code for commands that we stopped after a timeout
+returncode_timeout = -1
+
+
+def _kill(proc):
+    """Stop a command and anything it started."""
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+async def _pump(stream, emit):
+    """Send each line from a stream to emit, including carriage returns."""
+    pending = b''
+    while True:
+        chunk = await stream.read(65536)
+        if not chunk:
+            break
+        pending += chunk
+        lines = re.split(b'\r\n?|\n', pending)
+        pending = lines.pop()
+        for line in lines:
+            emit(line.decode('utf-8', 'replace'))
+    if pending:
+        emit(pending.decode('utf-8', 'replace'))
+
+
+async def _run(command, cwd=None, timeout=None, tag=None, scroll=True,
+               log=None, scroll_log=False):
+    """Run one command and collect the result."""
+    lines = []
+
+    def emit(line):
+        lines.append(line)
+        if log:
+            log.write(line + '\n')
+        if scroll:
+            if log and scroll_log:
+                line = '[LOG] %s | %s' % (log.name, line.strip(' '))
+            sys.stdout.write((tag or '') + line + '\n')
+            sys.stdout.flush()
+
+    kwargs = dict(cwd=cwd, stdout=asyncio.subprocess.PIPE,
+                  stderr=asyncio.subprocess.STDOUT,
+                  # a new session lets us stop the children on a timeout
+                  #   but it also hides them from ctrl-c so we avoid it
+                  #   for commands without a timeout
+                  start_new_session=timeout is not None)
+    argv = shell_free(command)
+    try:
+        # simple commands run directly instead of through a shell
+        if argv:
+            proc = await asyncio.create_subprocess_exec(*argv, **kwargs)
+        else:
+            proc = await asyncio.create_subprocess_shell(
+                command, executable='/bin/bash', **kwargs)
+    except OSError:
+        return dict(command=command, returncode=returncode_missing,
+                    stdout='', timeout=False)
+
+    async def finish():
+        # stderr is merged into stdout so there is one pipe to drain
+        await _pump(proc.stdout, emit)
+        await proc.wait()
+    timed_out = False
+    try:
+        await asyncio.wait_for(finish(), timeout)
+    except asyncio.TimeoutError:
+        timed_out = True
+        _kill(proc)
+        await proc.wait()
+    return dict(command=command, stdout='\n'.join(lines), timeout=timed_out,
+                returncode=returncode_timeout if timed_out else
+                proc.returncode)
+
+
+def run_commands(commands, cwd=None, timeout=None, tags=None, scroll=True,
+                 log=None, scroll_log=False):
+    """
+    Run a list of commands at the same time and return their results in
+    order. Each result has the returncode, the stdout (merged with stderr),
+    and a timeout flag. The tags, one per command, prefix their output and
+    default to the output tag of the calling thread.
+    A log file receives the output of every command.
+    """
+    thread_tag = getattr(output_tags, 'tag', None)
+    tags = [tag if tag is not None else (
+        '%s ' % thread_tag if thread_tag else None)
+        for tag in (tags or [None for i in commands])]
+    log_fp = open(log, 'a') if log else None
+
+    async def run_all():
+        return await asyncio.gather(*[
+            _run(command, cwd=cwd, timeout=timeout, tag=tag, scroll=scroll,
+                 log=log_fp, scroll_log=scroll_log)
+            for command, tag in zip(commands, tags)])
+    # each call has its own loop so that threads can run commands too
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(run_all())
+    finally:
+        loop.close()
+        if log_fp:
+            log_fp.close()
+
+
+def run_command(command, **kwargs):
+    """Run a single command with the options to run_commands."""
+    tag = kwargs.pop('tag', None)
+    return run_commands([command], tags=[tag], **kwargs)[0]
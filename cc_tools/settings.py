@@ -9,6 +9,8 @@ import os
 
 # the user settings file which comprises most of the user interface
 cc_user = 'cc.yaml'
+# the digests for the versions selected by the last refresh
+cc_lock = 'cc.yaml.lock'
 
 conda_name = 'community-collections'
 specs = {
@@ -18,6 +20,11 @@ specs = {
     # hardcoded by the cc wrapper for speed
     'envname': 'community-collections', }
 
+# modulefiles are staged here and published to the modulefiles tree
+modulefiles_store = 'modulefiles_store'
+# Lmod reads this spider cache through scDescriptT in cc_tools/lmodrc.lua
+spider_cache = 'spider_cache'
+
 with open(os.path.join(
           os.path.dirname(__file__), 'defaults_cc.yaml')) as fp:
     default_bootstrap = fp.read()
@@ -29,4 +36,24 @@ default_full = {}
 # default modulefile settings
 # these can be overridden by "module_settings" in cc.yaml
 default_modulefile_settings = dict(
-    source='docker',)
+    source='docker',
+    # number of concurrent registry queries during refresh
+    resolve_workers=8,
+    # seconds before a cached tag list is revalidated with the registry
+    registry_ttl=3600,
+    # write an Lmod spider cache so listing modules reads a single file
+    spider_cache=True,
+    # number of concurrent image downloads for ./cc prefetch
+    prefetch_workers=2,
+    # average download rate in KB/s for ./cc prefetch (0 is no cap)
+    prefetch_bandwidth=0,
+    # seconds to wait for another process to finish downloading an image
+    pull_timeout=7200,
+    # optional node-local directory for copies of the images, for example
+    #   $TMPDIR/cc_images, where shell variables are expanded on the node
+    local_images='',
+    # most space used in the local directory, for example 20G (0 is no limit)
+    local_images_budget=0,
+    # space for the images directory enforced by ./cc images gc, for example
+    #   50G, after which unused images are removed (0 removes them all)
+    images_budget=0,)
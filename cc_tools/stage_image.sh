@@ -0,0 +1,72 @@
+#!/bin/bash
+
+# NODE-LOCAL IMAGE STAGING
+# The shell functions in the modulefiles call this script to run an image
+#   from a node-local directory instead of the shared images directory.
+# A local copy is valid while its size and modification time match the
+#   shared image. New copies evict the least recently used copies until the
+#   directory fits in the budget (in bytes, where 0 means no limit).
+# The script prints the path to run, falling back to the shared image.
+# usage: stage_image.sh <local directory> <budget> <image>
+
+local_dn="$1"
+budget="$2"
+target="$3"
+name="$(basename "$target")"
+local_fn="$local_dn/$name"
+marker="$local_dn/.$name.used"
+
+fallback() {
+    echo "$target"
+    exit 0
+}
+stat_of() {
+    # images in the store are named by a symlink so we follow it
+    stat -L -c '%s %Y' "$1" 2>/dev/null
+}
+
+# sandboxes have too many files to copy so they run from the shared directory
+[ -n "$local_dn" ] && [ -f "$target" ] || fallback
+mkdir -p "$local_dn" 2>/dev/null || fallback
+if [ "$(stat_of "$local_fn")" == "$(stat_of "$target")" ]; then
+    touch "$marker"
+    echo "$local_fn"
+    exit 0
+fi
+
+# one copy at a time on each node
+exec 9>"$local_dn/.lock"
+flock 9 2>/dev/null
+if [ "$(stat_of "$local_fn")" == "$(stat_of "$target")" ]; then
+    touch "$marker"
+    echo "$local_fn"
+    exit 0
+fi
+size=$(stat -L -c '%s' "$target")
+if [ "$budget" -gt 0 ]; then
+    [ "$size" -le "$budget" ] || fallback
+    used=$(find "$local_dn" -maxdepth 1 -type f -name '*.sif' \
+        ! -name "$name" -printf '%s\n' | awk '{s+=$1} END {print s+0}')
+    # evict the least recently used copies until the new image fits
+    for old_marker in $(ls -tr "$local_dn"/.*.used 2>/dev/null); do
+        [ $((used + size)) -le "$budget" ] && break
+        old="$local_dn/$(basename "$old_marker" .used | sed 's/^\.//')"
+        [ "$old" == "$local_fn" ] && continue
+        if [ -f "$old" ]; then
+            echo "[CC] evicting $(basename "$old") from $local_dn" >&2
+            used=$((used - $(stat -c '%s' "$old")))
+            rm -f "$old"
+        fi
+        rm -f "$old_marker"
+    done
+    [ $((used + size)) -le "$budget" ] || fallback
+fi
+echo "[CC] copying $name to $local_dn" >&2
+temp="$local_dn/.$name.tmp.$$"
+if cp -p "$target" "$temp" && mv "$temp" "$local_fn"; then
+    touch "$marker"
+    echo "$local_fn"
+else
+    rm -f "$temp"
+    fallback
+fi
@@ -18,10 +18,11 @@ from . import stdtools  # noqa
 from .stdtools import introspect_function
 from .stdtools import str_types
 from .stdtools import tracebacker
+from .stdtools import lock_file
+from .stdtools import lock_command
 
 # for statedict
-import traceback
-from .stdtools import say
+import collections
 
 
 class Singleton(type):
@@ -37,12 +38,48 @@ class Singleton(type):
         return cls._instance
 
 
+def journal_delta(old, new):
+    """
+    Describe the changes to the top-level keys of a cache. Lists that only
+    grew at the end, like the log, are recorded by their new items.
+    """
+    delta = {}
+    for key, val in new.items():
+        if key not in old:
+            delta.setdefault('set', {})[key] = val
+        elif old[key] == val:
+            continue
+        elif (isinstance(val, list) and isinstance(old[key], list) and
+                val[:len(old[key])] == old[key]):
+            delta.setdefault('extend', {})[key] = val[len(old[key]):]
+        else:
+            delta.setdefault('set', {})[key] = val
+    dropped = [key for key in old if key not in new]
+    if dropped:
+        delta['del'] = dropped
+    return delta
+
+
+def journal_apply(cache, delta):
+    """Replay one journal entry from journal_delta onto a cache."""
+    cache.update(**delta.get('set', {}))
+    for key, val in delta.get('extend', {}).items():
+        cache[key] = cache.get(key, []) + val
+    for key in delta.get('del', []):
+        cache.pop(key, None)
+
+
 class Cacher(object):
     """
     Class decorator which supplies a cache and associated functions.
     Note that the child class needs to run a try/except like this one:
     To write the cache on failure or success use self._try_except or
     alternately self._try_else otherwise the cache is not saved!
+    The standard cache policy rewrites the whole cache on each save while the
+    journal policy appends only the changes to a journal beside the cache
+    and folds them into the cache after journal_limit saves.
+    The lock policy holds an exclusive lock on the cache from reading it
+    until it is saved so that concurrent commands take turns.
     """
     def __init__(
         self,
@@ -53,7 +90,10 @@ class Cacher(object):
         cache_policy='standard',
         errorclear_policy='clear',
         establish_policy='check',
-            reserve_policy=True):
+        reserve_policy=True,
+        lock_policy=True,
+        read_commands=(),
+            journal_limit=50):
         if not isinstance(cache_fn, str_types):
             raise Exception((
                 'The argument to Cacher must be a string, '
@@ -69,6 +109,9 @@ class Cacher(object):
         self.errorclear_policy = errorclear_policy
         self.establish_policy = establish_policy
         self.reserve_policy = reserve_policy
+        self.journal_limit = journal_limit
+        self.lock_policy = lock_policy
+        self.read_commands = read_commands
 
     def __call__(self, cls):
         # when using a class decorator is that the derived class is a singleton
@@ -82,6 +125,12 @@ class Cacher(object):
             errorclear_policy = self.errorclear_policy
             establish_policy = self.establish_policy
             reserve_policy = self.reserve_policy
+            journal_limit = self.journal_limit
+            lock_policy = self.lock_policy
+            read_commands = self.read_commands
+            # commands which only read the cache share the lock
+            cache_read = False
+            journal_fn = '%s.journal' % self.cache_fn
             closer = self.closer
 
             def __init__(self):
@@ -90,28 +139,52 @@ class Cacher(object):
                 # an empty cache policy means we do not use it
                 if self.cache_policy == 'empty':
                     return
+                # hold the lock across the read, update, and write
+                self.cache_read = lock_command() in self.read_commands
+                self.cache_lock = (lock_file(
+                    self.cache_fn, shared=self.cache_read)
+                    if self.lock_policy else None)
+                # the journal sequence number included in the cache file
+                self.journal_seq, self.journal_count = 0, 0
                 # load
                 if not os.path.isfile(self.cache_fn):
                     pass
                 else:
                     print('status reading %s' % self.cache_fn)
-                    with open(self.cache_fn) as fp:
-                        incoming = json.load(fp)
-                        # avoid collisions here?
-                        self.cache.update(**incoming)
-                if self.reserve_policy:
-                    self.cache_copy = copy.deepcopy(self.cache)
+                    try:
+                        with open(self.cache_fn) as fp:
+                            incoming = json.load(fp)
+                    # older versions could leave a partial cache
+                    except ValueError:
+                        print('warning %s is unreadable so we are moving it '
+                              'to %s.bad' % (self.cache_fn, self.cache_fn))
+                        os.rename(self.cache_fn, '%s.bad' % self.cache_fn)
+                        incoming = {}
+                    self.journal_seq = incoming.pop('_journal', 0)
+                    # avoid collisions here?
+                    self.cache.update(**incoming)
+                if self.cache_policy == 'journal':
+                    self._journal_replay()
+                self._reserve()
                 self.errorclear()
                 # initialize the parent class
                 super(cls, self).__init__()
 
+            def _unlock(self):
+                """Release the cache so other commands can use it."""
+                if getattr(self, 'cache_lock', None):
+                    self.cache_lock.close()
+                    self.cache_lock = None
+
             def _try_except(self, exception=None):
                 # the languish flag turns off the Cacher
                 if self.cache.get('languish', False):
+                    self._unlock()
                     return
                 if self.cache_policy != 'empty':
                     self.cache['error'] = str(exception)
                 self._standard_write()
+                self._unlock()
                 if exception is not None:
                     # suppress exceptions if requested
                     if not self.cache.pop('traceback_off', False):
@@ -122,23 +195,106 @@ class Cacher(object):
             def _try_else(self):
                 # the languish flag turns off the Cacher
                 if self.cache.get('languish', False):
+                    self._unlock()
                     return
                 # apply the hooks before write
                 # hooks are not used on _try_except above for debugging
                 if self.closer:
                     self.closer()
                 self._standard_write()
+                self._unlock()
+
+            def _write_full(self, extra=None):
+                """Replace the cache file in one step so it is never half
+                written if we are interrupted."""
+                fn_temp = '%s.tmp' % self.cache_fn
+                with open(fn_temp, 'w') as fp:
+                    json.dump(dict(self.cache, **(extra or {})), fp)
+                os.rename(fn_temp, self.cache_fn)
+
+            def _journal_replay(self):
+                """Apply the journal entries newer than the cache file."""
+                if not os.path.isfile(self.journal_fn):
+                    return
+                with open(self.journal_fn) as fp:
+                    for line in fp:
+                        try:
+                            entry = json.loads(line)
+                        # an interrupted save leaves at most one partial line
+                        except ValueError:
+                            break
+                        self.journal_count += 1
+                        if entry['seq'] > self.journal_seq:
+                            journal_apply(self.cache, entry['delta'])
+                            self.journal_seq = entry['seq']
+
+            def _reserve(self):
+                """Mark the cache as saved so we can detect changes."""
+                if not self.reserve_policy:
+                    return
+                # the state tracks its own changes so we avoid a copy
+                elif isinstance(self.cache, StateDict):
+                    self.cache.settle()
+                    self.cache_copy = None
+                else:
+                    self.cache_copy = copy.deepcopy(self.cache)
+
+            def _changed(self):
+                if isinstance(self.cache, StateDict):
+                    return self.cache.changed
+                # a replaced cache has nothing to compare with
+                return (self.cache_copy is None or
+                        self.cache != self.cache_copy)
+
+            def _journal_write(self):
+                if not self.reserve_policy:
+                    delta = None
+                elif isinstance(self.cache, StateDict):
+                    delta = self.cache.delta()
+                # a replaced cache has nothing to compare with
+                elif self.cache_copy is None:
+                    delta = None
+                else:
+                    delta = journal_delta(self.cache_copy, self.cache)
+                if delta == {}:
+                    print('status cache is unchanged')
+                    return
+                # fold the journal into the cache file when it gets long
+                if (delta is None or not os.path.isfile(self.cache_fn) or
+                        self.journal_count >= self.journal_limit):
+                    print('status compacting %s' % self.journal_fn)
+                    self._write_full(extra={'_journal': self.journal_seq})
+                    if os.path.isfile(self.journal_fn):
+                        os.remove(self.journal_fn)
+                    self.journal_count = 0
+                    self._reserve()
+                    return
+                self.journal_seq += 1
+                print('status writing %s' % self.journal_fn)
+                with open(self.journal_fn, 'a') as fp:
+                    fp.write(json.dumps(dict(
+                        seq=self.journal_seq, delta=delta)) + '\n')
+                self.journal_count += 1
+                self._reserve()
 
             def _standard_write(self):
+                # readers leave the cache file to the commands that write it
+                if self.cache_read:
+                    return
+                # keep the trace from a debugging run in the cache
+                if isinstance(self.cache, TracingStateDict):
+                    self.cache.save_trace()
                 if self.cache_policy == 'standard':
                     if self.reserve_policy:
-                        if self.cache == self.cache_copy:
+                        if not self._changed():
                             print('status cache is unchanged')
                             return
                     # standard write
                     print('status writing %s' % self.cache_fn)
-                    with open(self.cache_fn, 'w') as fp:
-                        json.dump(self.cache, fp)
+                    self._write_full()
+                    self._reserve()
+                elif self.cache_policy == 'journal':
+                    self._journal_write()
                 elif self.cache_policy == 'empty':
                     pass
                 else:
@@ -214,6 +370,13 @@ class Parser:
                 [i for i in subcommand_names if i not in parser_order])
         parser = argparse.ArgumentParser(
             description='Community Collections Manager.')
+        # the Cacher reads the lock policy before we parse the arguments
+        parser.add_argument(
+            '--no-wait', dest='wait', action='store_false',
+            help='Exit instead of waiting when another command holds a lock.')
+        parser.add_argument('--wait', dest='wait', action='store_true',
+                            help='Wait for locks held by other commands.')
+        parser.set_defaults(wait=True)
         subparsers = parser.add_subparsers(
             title='subcommands',
             description='Valid subcommands:',
@@ -223,7 +386,8 @@ class Parser:
             detail = {}
             if hasattr(func, '__doc__'):
                 detail['help'] = func.__doc__
-            sub = subparsers.add_parser(name, **detail)
+            # multi-word commands use hyphens on the command line
+            sub = subparsers.add_parser(name.replace('_', '-'), **detail)
             # introspection
             inspected = introspect_function(func)
             if ('func' in inspected['args']
@@ -245,6 +409,11 @@ class Parser:
                         sub.add_argument('--%s' % arg, dest=arg,
                                          action='store_true')
                     sub.set_defaults(**{arg: val})
+                # a tuple default collects any number of positional values
+                elif isinstance(val, tuple):
+                    sub.add_argument(arg, nargs='*', default=list(val),
+                                     help='Default for "%s": %s.' %
+                                     (arg, str(list(val))))
                 elif isinstance(val, str_types):
                     sub.add_argument('--%s' % arg,
                                      dest=arg, default=val, type=str,
@@ -280,6 +449,9 @@ class Parser:
         """Main execution loop for a subcommand with handler and else"""
         func = args.func
         delattr(args, 'func')
+        # the global lock policy is not an argument to the command
+        if hasattr(args, 'wait'):
+            delattr(args, 'wait')
         func(**vars(args))
 
     def debug(self):
@@ -311,62 +483,261 @@ class Convey(object):
     def __call__(self, cls):
         # when using a class decorator is that the derived class is a singleton
         class Convey(cls):
+            # Handler shares the taxonomy of cls with this subclass
+            _conveyed = True
             for key in self._keys:
                 setattr(cls, key, getattr(self, key))
         Convey.__name__ = cls.__name__
         return Convey
 
 
+def _tracked(value, owner, key):
+    """Wrap dicts and lists so that changes inside them mark a state key."""
+    # containers already tracked for this key are kept as they are
+    if isinstance(value, (TrackedDict, TrackedList)) and \
+            value._owner is owner and value._key == key and \
+            not getattr(value, '_top', False):
+        return value
+    elif isinstance(value, dict):
+        return TrackedDict(owner, key, value)
+    elif isinstance(value, list):
+        return TrackedList(owner, key, value, top=False)
+    return value
+
+
+class TrackedDict(dict):
+    """
+    Dictionary inside the state which reports changes to the top-level key
+    that holds it. Values are copied into tracked containers on assignment.
+    """
+    def __init__(self, owner, key, items=()):
+        self._owner, self._key = owner, key
+        super(TrackedDict, self).__init__([
+            (k, _tracked(v, owner, key)) for k, v in dict(items).items()])
+
+    def _mark(self):
+        self._owner._mark(self._key)
+
+    def __deepcopy__(self, memo):
+        # copies leave the state as plain dictionaries
+        return dict([(k, copy.deepcopy(v, memo)) for k, v in self.items()])
+
+    def __setitem__(self, k, v):
+        self._mark()
+        super(TrackedDict, self).__setitem__(
+            k, _tracked(v, self._owner, self._key))
+
+    def __delitem__(self, k):
+        self._mark()
+        super(TrackedDict, self).__delitem__(k)
+
+    def update(self, *args, **kwargs):
+        for k, v in dict(*args, **kwargs).items():
+            self[k] = v
+
+    def setdefault(self, k, d=None):
+        if k not in self:
+            self[k] = d
+        return super(TrackedDict, self).__getitem__(k)
+
+    def pop(self, *args):
+        self._mark()
+        return super(TrackedDict, self).pop(*args)
+
+    def popitem(self):
+        self._mark()
+        return super(TrackedDict, self).popitem()
+
+    def clear(self):
+        self._mark()
+        super(TrackedDict, self).clear()
+
+
+class TrackedList(list):
+    """
+    List inside the state which reports changes to the top-level key that
+    holds it. Appending to a top-level list like the log is noted as such so
+    that the journal can record only the new items.
+    """
+    def __init__(self, owner, key, items=(), top=True):
+        self._owner, self._key, self._top = owner, key, top
+        super(TrackedList, self).__init__([
+            _tracked(v, owner, key) for v in items])
+
+    def _mark(self, grown=False):
+        self._owner._mark(
+            self._key, start=len(self) if grown and self._top else None)
+
+    def __deepcopy__(self, memo):
+        return [copy.deepcopy(v, memo) for v in self]
+
+    def append(self, v):
+        self._mark(grown=True)
+        super(TrackedList, self).append(_tracked(v, self._owner, self._key))
+
+    def extend(self, vals):
+        self._mark(grown=True)
+        super(TrackedList, self).extend([
+            _tracked(v, self._owner, self._key) for v in vals])
+
+    def __iadd__(self, vals):
+        self.extend(vals)
+        return self
+
+    def __setitem__(self, i, v):
+        self._mark()
+        if isinstance(i, slice):
+            v = [_tracked(j, self._owner, self._key) for j in v]
+        else:
+            v = _tracked(v, self._owner, self._key)
+        super(TrackedList, self).__setitem__(i, v)
+
+    def __delitem__(self, i):
+        self._mark()
+        super(TrackedList, self).__delitem__(i)
+
+    def insert(self, i, v):
+        self._mark()
+        super(TrackedList, self).insert(i, _tracked(v, self._owner, self._key))
+
+    def pop(self, *args):
+        self._mark()
+        return super(TrackedList, self).pop(*args)
+
+    def remove(self, v):
+        self._mark()
+        super(TrackedList, self).remove(v)
+
+    def sort(self, *args, **kwargs):
+        self._mark()
+        super(TrackedList, self).sort(*args, **kwargs)
+
+    def reverse(self):
+        self._mark()
+        super(TrackedList, self).reverse()
+
+    def __imul__(self, n):
+        self._mark()
+        return super(TrackedList, self).__imul__(n)
+
+
 class StateDict(dict):
     """
     Special dictionary for watching what happens to the state.
-    Prototype only.
+    Reads are plain dictionary reads. Use trace to watch every access.
+    Each change increments the version and records the top-level key that
+    changed so the Cacher can decide whether to save without comparing the
+    whole state. Lists that only grew at the end remember where they grew.
     """
     def __init__(self, debug=False, *args, **kwargs):
-        self._debug = debug
-        super(StateDict, self).__init__(*args, **kwargs)
+        self.version = 0
+        self._changes = {}
+        super(StateDict, self).__init__()
+        self.update(*args, **kwargs)
+        if debug:
+            self.trace()
+
+    def _mark(self, key, start=None):
+        self.version += 1
+        if start is None or self._changes.get(key, start) is None:
+            self._changes[key] = None
+        else:
+            self._changes.setdefault(key, start)
+
+    @property
+    def changed(self):
+        return bool(self._changes)
+
+    def settle(self):
+        """Forget the changes after the state is saved."""
+        self._changes = {}
+
+    def delta(self):
+        """Changes since the last save in the format from journal_delta."""
+        delta = {}
+        for key, start in self._changes.items():
+            if key not in self:
+                delta.setdefault('del', []).append(key)
+            elif start is None:
+                delta.setdefault('set', {})[key] = dict.__getitem__(self, key)
+            else:
+                delta.setdefault('extend', {})[key] = dict.__getitem__(
+                    self, key)[start:]
+        return delta
 
-    def _get_line(self):
-        """Get the line that brought you here."""
-        # does not work on python 2
-        if sys.version_info < (3, 0):
+    def trace(self, size=1000):
+        """Start recording accesses to the state in a TracingStateDict."""
+        self.__class__ = TracingStateDict
+        self._trace = collections.deque(maxlen=size)
+
+    def __setitem__(self, x, y):
+        # in-place operators like += assign the same list back to the key
+        if super(StateDict, self).get(x) is y and \
+                isinstance(y, (TrackedDict, TrackedList)):
             return
-        try:
-            raise Exception('introspection-exception')
-        except:
-            stack = traceback.extract_stack()
-            # the choice of 3 is probably static
-            # note that if the line does not have state or self.cache
-            #   in it, this might be earlier in the broken line
-            #   because the stack line does not read to the true abstract
-            #   beginning of the line
-            where = stack[-3]
-            print('debug we are in %s lineno %d line: `%s`' % (
-                where.filename, where.lineno, where.line))
-        return
+        self._mark(x)
+        if isinstance(y, list):
+            y = TrackedList(self, x, y)
+        else:
+            y = _tracked(y, self, x)
+        return super(StateDict, self).__setitem__(x, y)
 
-    def _say(self, x): return say(x, 'red_black')
+    def __delitem__(self, x):
+        self._mark(x)
+        return super(StateDict, self).__delitem__(x)
 
-    def get(self, x, d=None):
-        if self._debug:
-            print('debug state get "%s"' % self._say(x))
-            self._get_line()
-        return super(StateDict, self).get(x, d)
+    def update(self, *args, **kwargs):
+        for key, val in dict(*args, **kwargs).items():
+            self[key] = val
 
-    def __getitem__(self, x):
-        if self._debug:
-            print('debug state get "%s"' % self._say(x))
-            self._get_line()
+    def setdefault(self, x, d=None):
+        if x not in self:
+            self[x] = d
         return super(StateDict, self).__getitem__(x)
 
-    def set(self, x, y):
-        if self._debug:
-            print('debug state set "%s" "%s"' % (self._say(x), self._say(y)))
-            self._get_line()
-        return super(StateDict, self).set(x, y)
+    def pop(self, x, *args):
+        if x in self:
+            self._mark(x)
+        return super(StateDict, self).pop(x, *args)
+
+    def popitem(self):
+        key, val = super(StateDict, self).popitem()
+        self._mark(key)
+        return key, val
+
+    def clear(self):
+        for key in self:
+            self._mark(key)
+        super(StateDict, self).clear()
+
+
+class TracingStateDict(StateDict):
+    """
+    State which records the accessor, key, and caller of each access in a
+    ring buffer. Use StateDict.trace to switch the state to this class and
+    save_trace to keep the buffer in the state for ./cc showcache --trace.
+    """
+    def _record(self, accessor, key):
+        caller = sys._getframe(2)
+        self._trace.append([accessor, str(key), '%s:%d' % (
+            os.path.basename(caller.f_code.co_filename), caller.f_lineno)])
+
+    def get(self, x, d=None):
+        self._record('get', x)
+        return super(TracingStateDict, self).get(x, d)
+
+    def __getitem__(self, x):
+        self._record('get', x)
+        return super(TracingStateDict, self).__getitem__(x)
 
     def __setitem__(self, x, y):
-        if self._debug:
-            print('debug state set "%s" "%s"' % (self._say(x), self._say(y)))
-            self._get_line()
-        return super(StateDict, self).__setitem__(x, y)
+        self._record('set', x)
+        return super(TracingStateDict, self).__setitem__(x, y)
+
+    def __delitem__(self, x):
+        self._record('del', x)
+        return super(TracingStateDict, self).__delitem__(x)
+
+    def save_trace(self):
+        dict.__setitem__(self, 'trace', list(self._trace))
+        self._mark('trace')
@@ -23,6 +23,14 @@ basestring = string_types = str_types = (str, unicode) if sys.version_info < (3,
 
 # COLOR PRINTER (requires compatibility above)
 
+# threads can tag their output, for example with the name of a manager
+output_tags = threading.local()
+
+
+def tag_output(tag=None):
+    """Prefix the output printed by the current thread with a tag."""
+    output_tags.tag = tag
+
 
 def say(text, *flags):
     """Colorize the text."""
@@ -78,41 +86,142 @@ def color_printer(override=False, prefix=None):
 
         def print_stylized(*args, **kwargs):
             """Custom print function."""
+            # output from threads may carry a tag
+            tag = getattr(output_tags, 'tag', None)
+            lead = (tag,) if tag and args else ()
             if (len(args) > 0 and
                     isinstance(args[0], str_types) and args[0] in key_leads):
-                return _print('[%s]' % args[0].upper(), *args[1:])
+                return _print(*(lead + ('[%s]' % args[0].upper(),) +
+                                args[1:]))
             # regex here adds very little time and allows more natural print
             # statements to be capitalized
             # note that we can retire all print('debug','message') statements
             elif len(args) == 1 and isinstance(args[0], str_types):
                 match = key_leads_regex.match(args[0])
                 if match:
-                    return _print(prefix+'[%s]' % match.group(1).upper() +
+                    return _print(prefix + ('%s ' % tag if tag else '') +
+                                  '[%s]' % match.group(1).upper() +
                                   ' ' + match.group(2), **kwargs)
                 else:
-                    return _print(*args, **kwargs)
+                    return _print(*(lead + args), **kwargs)
             else:
-                return _print(*args, **kwargs)
+                return _print(*(lead + args), **kwargs)
         # export custom print function before other imports
         # this code ensures that in python 3 we overload print
         #   while any python 2 code that wishes to use overloaded print
         #   must of course from __future__ import print_function
         builtins.print = print_stylized
 
+# FILE LOCKS
+
+
+def lock_wait(argv=None):
+    """Read the global --wait/--no-wait flag which comes before a command."""
+    import argparse
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument('--wait', dest='wait', action='store_true')
+    parser.add_argument('--no-wait', dest='wait', action='store_false')
+    parser.set_defaults(wait=True)
+    return parser.parse_known_args(
+        sys.argv[1:] if argv is None else argv)[0].wait
+
+
+def lock_command(argv=None):
+    """Find the subcommand, which is the first argument that is not a flag."""
+    for arg in (sys.argv[1:] if argv is None else argv):
+        if not arg.startswith('-'):
+            # multi-word commands use hyphens on the command line
+            return arg.replace('-', '_')
+    return None
+
+
+def lock_file(fn, shared=False, wait=None):
+    """
+    Take an advisory lock on a sidecar file next to fn. Readers share the
+    lock while writers hold it alone. Returns the open file which holds the
+    lock until it is closed or the process ends.
+    """
+    import fcntl
+    if wait is None:
+        wait = lock_wait()
+    fp = open('%s.flock' % fn, 'a')
+    mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    try:
+        fcntl.flock(fp, mode | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        if not wait:
+            fp.close()
+            raise Exception('another command is using %s. Rerun it later or '
+                            'use --wait to wait for the lock.' % fn)
+        print('status waiting for another command to release %s' % fn)
+        fcntl.flock(fp, mode)
+    return fp
+
 # BASH INTERFACE
 
 
-def command_check(command, cwd=None, quiet=False):
-    """Run a command and see if it completes with returncode zero."""
+# characters which need a shell to interpret a command
+shell_syntax = re.compile(r'[|&;<>()$`\\"\'*?\[\]#~=%!{}\n]')
+shell_builtins = ['.', 'alias', 'cd', 'command', 'eval', 'exec', 'exit',
+                  'export', 'hash', 'read', 'set', 'source', 'type', 'ulimit',
+                  'umask', 'unset']
+
+
+# the asyncio runner needs the child watcher that python 3.8 attaches to new
+#   event loops in any thread, so older versions use subprocess directly
+use_runner = sys.version_info >= (3, 8)
+
+
+def shell_free(command):
+    """
+    Split a command into arguments when it can run without a shell.
+    Returns None when the command needs bash.
+    """
+    if not isinstance(command, str_types) or shell_syntax.search(command):
+        return None
+    args = command.split()
+    if not args or args[0] in shell_builtins:
+        return None
+    # commands that are not on the path are left to bash to report
+    if os.path.sep not in args[0]:
+        try:
+            from shutil import which as find_executable
+        except ImportError:
+            from distutils.spawn import find_executable
+        if not find_executable(args[0]):
+            return None
+    return args
+
+
+def command_check(command, cwd=None, quiet=False, timeout=None):
+    """
+    Run a command and see if it completes with returncode zero.
+    Simple commands run without a shell and the timeout is in seconds.
+    """
     kwargs = {}
     if cwd:
         kwargs['cwd'] = cwd
     try:
+        if use_runner:
+            from .runner import run_command
+            return run_command(command, cwd=cwd, timeout=timeout,
+                               scroll=False)['returncode']
+        # python 2 cannot stop a command after a timeout
+        wait = dict(timeout=timeout) if sys.version_info >= (3, 3) else {}
         with open(os.devnull, 'w') as FNULL:
-            proc = subprocess.Popen(command, stdout=FNULL,
-                                    stderr=FNULL, shell=True,
-                                    executable='/bin/bash', **kwargs)
-            proc.communicate()
+            argv = shell_free(command)
+            if argv:
+                proc = subprocess.Popen(argv, stdout=FNULL,
+                                        stderr=FNULL, **kwargs)
+            else:
+                proc = subprocess.Popen(command, stdout=FNULL,
+                                        stderr=FNULL, shell=True,
+                                        executable='/bin/bash', **kwargs)
+            try:
+                proc.communicate(**wait)
+            except Exception:
+                proc.kill()
+                raise
             return proc.returncode
     except Exception as e:
         if not quiet:
@@ -122,14 +231,79 @@ def command_check(command, cwd=None, quiet=False):
         return -1
 
 
+def probe_fingerprint(command, cwd=None, files=()):
+    """
+    Describe what a probe depends on: the PATH and the modification times of
+    the program it runs and any other files the caller names.
+    """
+    files = list(files)
+    argv = shell_free(command)
+    if argv:
+        if os.path.sep in argv[0]:
+            files.append(os.path.join(cwd or '.', argv[0]))
+        else:
+            try:
+                from shutil import which as find_executable
+            except ImportError:
+                from distutils.spawn import find_executable
+            files.append(find_executable(argv[0]))
+    mtimes = {}
+    files = [fn for fn in files if fn]
+    for fn in files:
+        fn = os.path.realpath(fn)
+        mtimes[fn] = os.path.getmtime(fn) if os.path.exists(fn) else None
+    return {'path': os.environ.get('PATH', ''), 'mtimes': mtimes}
+
+
+def probe(probes, command, cwd=None, files=(), timeout=None):
+    """
+    Run a command which detects part of the environment and remember the
+    answer in the probes dictionary (usually the probes key of the state).
+    A remembered answer is reused until the PATH or the modification time of
+    the program or the files changes. Only successful probes are remembered
+    so that failures are always checked again.
+    Returns a dictionary with the returncode and the stdout (with stderr).
+    """
+    key = '%s @ %s' % (command, os.path.realpath(cwd or '.'))
+    fingerprint = probe_fingerprint(command, cwd=cwd, files=files)
+    known = probes.get(key)
+    if known and known['fingerprint'] == fingerprint:
+        return dict(returncode=0, stdout=known['stdout'])
+    if use_runner:
+        from .runner import run_command
+        result = run_command(command, cwd=cwd, timeout=timeout, scroll=False)
+    else:
+        proc = subprocess.Popen(command, cwd=cwd, shell=True,
+                                executable='/bin/bash',
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT)
+        wait = dict(timeout=timeout) if sys.version_info >= (3, 3) else {}
+        try:
+            # match the runner which drops the final newline
+            stdout = proc.communicate(**wait)[0].decode('utf-8').rstrip('\n')
+        # a timeout fails the probe
+        except Exception:
+            proc.kill()
+            proc.communicate()
+            stdout = ''
+        result = dict(returncode=proc.returncode, stdout=stdout)
+    if result['returncode'] == 0:
+        probes[key] = dict(fingerprint=fingerprint, stdout=result['stdout'])
+    else:
+        probes.pop(key, None)
+    return dict(returncode=result['returncode'], stdout=result['stdout'])
+
+
 def bash(command, log=None, cwd=None, inpipe=None, scroll=True, tag=None,
          announce=False, local=False, scroll_log=True, quiet=False,
-         exit_error=True):
+         exit_error=True, timeout=None):
     """
     Run a bash command.
     Development note: tee functionality would be useful however you cannot use
     pipes with subprocess here.  Vital note: log is relative to the current
     location and not the cwd.
+    Scrolling output streams through the event loop in runner on python 3.8
+    and later where the timeout (in seconds) stops the command.
     """
     if announce:
         print('status', 'ortho.bash%s runs command: %s' % (' (at %s)' % cwd
@@ -144,7 +318,23 @@ def bash(command, log=None, cwd=None, inpipe=None, scroll=True, tag=None,
                 log = os.path.relpath(log, cwd_local)
             pwd = os.getcwd()
             os.chdir(cwd_local)
-    if log is None:
+    if scroll and not inpipe and use_runner:
+        from .runner import run_command
+        result = run_command(
+            command, cwd=cwd, timeout=timeout, tag=tag, log=log,
+            scroll_log=bool(log and scroll is True and scroll_log))
+        if local:
+            os.chdir(pwd)
+        if result['timeout']:
+            raise Exception('bash command timed out after %ss: %s' %
+                            (timeout, command))
+        if result['returncode'] and exit_error:
+            if log:
+                raise Exception('bash error, see %s' % log)
+            raise Exception('see above for error. bash return code %d'
+                            % result['returncode'])
+        return None
+    elif log is None:
         # no present need to separate stdout and stderr so note the pipe below
         merge_stdout_stderr = True
         kwargs = dict(cwd=cwd, shell=True, executable='/bin/bash',
@@ -381,7 +571,7 @@ def asciitree(obj, depth=0, wide=2, last=[], recursed=False):
             all([type(i) in [str, float, int, bool] for i in obj.values()]) \
             and depth == 0:
         asciitree({'HASH': obj}, depth=1, recursed=True)
-    elif type(obj) in [list, tuple]:
+    elif isinstance(obj, (list, tuple)):
         for ind, item in enumerate(obj):
             spacer_this = spacer_both['end'] if ind == len(obj)-1 else spacer
             if type(item) in [float, int, bool] + str_types_list:
@@ -400,11 +590,12 @@ def asciitree(obj, depth=0, wide=2, last=[], recursed=False):
                 print(spacer_this+str(key)+' = '+str(obj[key]))
             # special: print single-item lists of strings on the same line as
             # the key
-            elif type(obj[key]) == list and len(obj[key]) == 1 and \
+            elif isinstance(obj[key], list) and len(obj[key]) == 1 and \
                     type(obj[key][0]) in [str, float, int, bool]:
                 print(spacer_this+key+' = '+str(obj[key]))
             # special: skip lists if blank dictionaries
-            elif type(obj[key]) == list and all([i == {} for i in obj[key]]):
+            elif isinstance(obj[key], list) and \
+                    all([i == {} for i in obj[key]]):
                 print(spacer_this+key+' = (empty)')
             elif obj[key] != {}:
                 # fancy border for top level
@@ -421,7 +612,7 @@ def asciitree(obj, depth=0, wide=2, last=[], recursed=False):
                     asciitree(obj[key], depth=depth+1,
                               last=last+([depth] if ind == len(obj)-1 else []),
                               recursed=True)
-            elif type(obj[key]) == list and obj[key] == []:
+            elif isinstance(obj[key], list) and obj[key] == []:
                 print(spacer_this+'(empty)')
             elif obj[key] == {}:
                 print(spacer_this+'%s = {}' % key)
@@ -472,6 +663,8 @@ def treeview(data, style='unicode'):
 
 class Handler(object):
     _taxonomy = {}
+    # classify results by keyword names shared by the instances of a class
+    _dispatch = None
     # internals map to special structures in the Handler level
     _internals = {'name': 'name', 'meta': 'meta'}
     # whether to allow inexact matching (we still prefer strict matching)
@@ -506,6 +699,16 @@ class Handler(object):
             {'args': args, 'name': name_child})
 
     def _classify(self, *args):
+        """Find the method for a set of keyword names."""
+        if self._dispatch is None:
+            return self._classify_scan(*args)
+        key = frozenset(args)
+        if key not in self._dispatch:
+            # failures raise so only successful matches are remembered
+            self._dispatch[key] = self._classify_scan(*args)
+        return self._dispatch[key]
+
+    def _classify_scan(self, *args):
         matches = [name for name, keys in self._taxonomy.items() if (
             (isinstance(keys, set) and keys == set(args)) or
             (isinstance(keys, dict) and set(keys.keys()) == {'base', 'opts'}
@@ -552,6 +755,41 @@ class Handler(object):
             return matches[0]
 
     def _taxonomy_inference(self):
+        """
+        Use the taxonomy inferred for this class. Every instance of a class
+        has the same methods so we infer them once and share the result.
+        Subclasses made by Convey only add attributes so they share the
+        taxonomy of the class they decorate.
+        """
+        owner = next(cls for cls in type(self).__mro__
+                     if not cls.__dict__.get('_conveyed', False))
+        if '_taxonomy_memo' not in owner.__dict__:
+            taxonomy, default = self._taxonomy_infer()
+            owner._taxonomy_memo = (
+                taxonomy, default, self._dispatch_table(taxonomy))
+        self._taxonomy, self._default, self._dispatch = owner._taxonomy_memo
+
+    @staticmethod
+    def _dispatch_table(taxonomy):
+        """
+        Precompile the exact matches for methods without optional keywords.
+        Other keyword sets are classified once and added by _classify.
+        """
+        strict = dict([(name, keys) for name, keys in taxonomy.items()
+                       if set(keys.keys()) == {'base', 'opts'}])
+        table = {}
+        for name, keys in strict.items():
+            if keys['opts']:
+                continue
+            key = frozenset(keys['base'])
+            matches = [i for i, j in strict.items() if (
+                key - j['opts'] == j['base'] and key - j['base'] <= j['opts'])]
+            # redundant methods are left for _classify_scan to report
+            if matches == [name]:
+                table[key] = name
+        return table
+
+    def _taxonomy_infer(self):
         """
         Infer a taxonomy from constituent functions. The taxonomy enumerates
         which functions are called when required (base) and optional (opts)
@@ -578,7 +816,7 @@ class Handler(object):
                     raise Exception('function "%s" lacks the self argument' %
                                     name)
         # convert to a typical taxonomy structure
-        self._taxonomy = dict([(name, {
+        taxonomy = dict([(name, {
             'base': set(expect['args'])-set(['self']),
             'opts': set(expect['kwargs'].keys())
             }) for name, expect in expected.items()
@@ -588,22 +826,22 @@ class Handler(object):
         any functions with kwargs as a base argument via "**kwargs" are allowed
         to accept any arbitrary keyword arguments, as is the
         """
-        for key in self._taxonomy:
-            if ('kwargs' in self._taxonomy[key]['base']
+        for key in taxonomy:
+            if ('kwargs' in taxonomy[key]['base']
                     and 'kwargs' in expected[key].get('**', [])):
-                self._taxonomy[key]['base'].remove('kwargs')
-                self._taxonomy[key]['kwargs'] = True
+                taxonomy[key]['base'].remove('kwargs')
+                taxonomy[key]['kwargs'] = True
         # check for a single default handler that only accespts **kwargs
-        defaults = [i for i, j in self._taxonomy.items()
+        defaults = [i for i, j in taxonomy.items()
                     if j.get('kwargs', False) and len(j['base']) == 0
                     and len(j['opts']) == 0]
         if len(defaults) > 1:
             raise Exception(
                 'More than one function accepts only **kwargs: %s' % defaults)
         elif len(defaults) == 1:
-            self._default = defaults[0]
+            default = defaults[0]
         else:
-            self._default = None
+            default = None
         # check valid taxonomy
         # note that using a protected keyword in the method arguments can
         #   be very confusing. for example, when a method that takes a name
@@ -612,9 +850,9 @@ class Handler(object):
         #   attribute. hence we have a naming table called _internals and we
         #   protect against name collisions here
         collisions = {}
-        for key in self._taxonomy:
-            argnames = (list(self._taxonomy[key]['base']) +
-                        list(self._taxonomy[key]['opts']))
+        for key in taxonomy:
+            argnames = (list(taxonomy[key]['base']) +
+                        list(taxonomy[key]['opts']))
             collide = [i for i in self._internals.values() if i in argnames]
             if any(collide):
                 collisions[key] = collide
@@ -626,6 +864,7 @@ class Handler(object):
                 'arguments: %s. See internals above.') % (
                     self.__class__.__name__, collisions))
         # fallbacks = []
+        return taxonomy, default
 
     def __init__(self, *args, **kwargs):
         if args:
@@ -670,12 +909,12 @@ class Handler(object):
         # before we run the function to generate the object, we note the
         #   inherent attributes assigned by Handler, the parent, so we can
         #   later identify the novel keys
-        self._stock = dir(self)+['_stock', 'solution']
+        stock = set(self.__dict__)
         # introspect on the function to make sure the keys
         #   in the taxonomy match the available keys in the function?
         self.solution = getattr(self, fname)(**kwargs)
-        # make a list of new class attributes set during the method above
-        self._novel = tuple(set(dir(self)) - set(self._stock))
+        # make a list of new attributes set during the method above
+        self._novel = tuple(set(self.__dict__) - stock - set(['solution']))
 
     def __repr__(self):
         """Look at the subclass-specific parts of the object."""
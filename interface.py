@@ -31,11 +31,26 @@ from cc_tools import CCStack
 from cc_tools import UseCase
 from cc_tools.settings import cc_user
 from cc_tools.settings import specs
+from cc_tools.settings import default_modulefile_settings
 from cc_tools.misc import kickstart_yaml
 from cc_tools.misc import settings_resolver
 from cc_tools.misc import enforce_env
 from cc_tools.misc import write_user_yaml
+from cc_tools.misc import read_user_yaml
 from cc_tools.misc import cache_closer
+from cc_tools.misc import parse_bytes
+from cc_tools.execute import whitelist_filter
+from cc_tools.execute import whitelist_requests
+from cc_tools.execute import docker_repos
+from cc_tools.execute import fetch_repos
+from cc_tools.execute import rollback_modulefiles
+from cc_tools.execute import update_spider_cache
+from cc_tools.registry import write_snapshot
+from cc_tools.images import index_images
+from cc_tools.images import report_usage
+from cc_tools.images import collect_images
+from cc_tools.images import prefetch_requests
+from cc_tools.images import prefetch_images
 
 # emphasize text printed from cc
 color_printer(prefix=cc_tools.stdtools.say('[CC]', 'mag_gray'))
@@ -52,22 +67,24 @@ UseCase = Convey(state=state)(UseCase)
 
 @Cacher(
     cache_fn='cache.json',
+    cache_policy='journal',
     closer=cache_closer,
+    # these commands only read the cache so they can run at the same time
+    read_commands=('showcache', 'images', 'prefetch', 'snapshot_tags',
+                   'rollback', 'capable', 'enable', 'docs', 'flake8'),
     cache=state,)
 class Interface(Parser):
     """
     A single call to this interface.
     """
     def _get_settings(self):
-        import yaml
-        with open(cc_user) as fp:
-            raw = yaml.load(fp, Loader=yaml.SafeLoader)
+        raw = read_user_yaml()
         # save the raw yaml
         self.cache['settings_raw'] = raw
         # resolve the yaml with defaults if they are missing
-        settings = settings_resolver(raw)
-        self.cache['settings'] = settings
-        return settings
+        self.cache['settings'] = settings_resolver(raw)
+        # return the tracked copy so later changes reach the state
+        return self.cache['settings']
 
     def _bootstrap(self):
         """
@@ -108,20 +125,27 @@ class Interface(Parser):
         # you lose colors if you do this: bash('./cc refresh')
         # relative path okay here?
         print('status running a subshell to complete the installation')
+        # the subshell needs the cache lock
+        self._unlock()
         os.system('./cc refresh')
         sys.exit(0)
 
-    def refresh(self, debug=False):
+    def refresh(self, debug=False, offline=False,
+                snapshot='tags_snapshot.json'):
         """
         The MAIN function. Start here.
         Update modulefiles and install necessary components.
         This command interprets cc.yaml, which is created if needed.
         Install Community-Collections with this command, edit cc.yaml
         to customize it, and then refresh again.
+        Use the offline flag to resolve versions from a tag snapshot.
+        Use debug to record accesses to the state for showcache --trace.
         """
-        # turn on state debugging
+        # trace the state for ./cc showcache --trace
         if debug:
-            self.cache._debug = True
+            self.cache.trace()
+        # the offline flag carries the snapshot path to Execute
+        self.cache['offline'] = snapshot if offline else False
         # rerun the bootstrap if not ready or cache was removed
         if not self.cache.get('ready', False):
             print('status failed to find cache so running bootstrap again')
@@ -142,6 +166,100 @@ class Interface(Parser):
         # debug is also CLI function so no args
         # self.debug()
 
+    def snapshot_tags(self, snapshot='tags_snapshot.json'):
+        """
+        Save the registry tags for every whitelisted docker repository to a
+        single file so that "refresh --offline" can run without a network.
+        """
+        settings = self._get_settings()
+        module_settings = (settings.get('module_settings') or
+                           default_modulefile_settings)
+        whitelist = whitelist_filter(
+            settings.get('whitelist', {}), settings.get('blacklist'))
+        repos = docker_repos(whitelist_requests(whitelist), module_settings)
+        tags = fetch_repos(repos, module_settings)
+        for name, result in list(tags.items()):
+            if isinstance(result, Exception):
+                print('warning omitting %s from the snapshot: %s' %
+                      (name, result))
+                del tags[name]
+        write_snapshot(tags, fn=snapshot)
+        print('status wrote tags for %d repositories to %s' %
+              (len(tags), snapshot))
+
+    def rollback(self):
+        """
+        Restore the previous generation of modulefiles after a bad refresh.
+        Run this command again to undo the rollback.
+        """
+        if not self.cache.get('ready', False):
+            raise Exception('cannot find an installation to roll back')
+        rollback_modulefiles(self.cache['case']['modulefiles'])
+        update_spider_cache(
+            self.cache['case']['lmod'], self.cache['case']['modulefiles'],
+            enable=self.cache.get('module_settings', {}).get(
+                'spider_cache', default_modulefile_settings['spider_cache']))
+
+    def images(self, action, rescan=False, dryrun=False):
+        """
+        Manage the images directory from cc.yaml.
+        The index action lists the images that are present in the index
+        which the modulefiles read instead of checking each image.
+        The du action reports the image sizes recorded in the index.
+        Use rescan to measure every image again.
+        The gc action removes the least recently loaded images that are not
+        used by any module until the images fit in images_budget from
+        module_settings. Use dryrun to list them without removing them.
+        """
+        settings = self._get_settings()
+        if action == 'index':
+            index_images(settings['images'], rescan=rescan)
+        elif action == 'du':
+            if rescan:
+                index_images(settings['images'], rescan=True)
+            report_usage(settings['images'])
+        elif action == 'gc':
+            if not self.cache.get('ready', False):
+                raise Exception('cannot find the modules. Run ./cc refresh.')
+            collect_images(
+                settings['images'], self.cache['case']['modulefiles'],
+                budget=parse_bytes(
+                    (settings.get('module_settings') or {}).get(
+                        'images_budget',
+                        default_modulefile_settings['images_budget'])),
+                dryrun=dryrun)
+        else:
+            raise Exception('invalid action for images: %s' % action)
+
+    def prefetch(self, names=()):
+        """
+        Download the images for every resolved version on the whitelist,
+        or only for the named modules, so that loading them is instant.
+        Use prefetch_workers and prefetch_bandwidth in module_settings to
+        set the number of concurrent downloads and their average total rate
+        in KB/s.
+        """
+        if not self.cache.get('ready', False) or 'modules' not in self.cache:
+            raise Exception('cannot find the modules. Run ./cc refresh.')
+        settings = self._get_settings()
+        module_settings = self.cache.get('module_settings', {})
+        prefetch_images(
+            prefetch_requests(self.cache['modules'], names=names),
+            images=settings['images'],
+            singularity=self.cache['case']['singularity'],
+            sandbox=self.cache['case'].get('sandbox', False),
+            workers=module_settings.get(
+                'prefetch_workers',
+                default_modulefile_settings['prefetch_workers']),
+            bandwidth=module_settings.get(
+                'prefetch_bandwidth',
+                default_modulefile_settings['prefetch_bandwidth']),
+            timeout=module_settings.get(
+                'pull_timeout', default_modulefile_settings['pull_timeout']),
+            # singularity needs mksquashfs from the conda environment
+            path_extra=os.path.abspath(os.path.join(
+                specs['miniconda'], 'envs', specs['envname'], 'bin')))
+
     def profile(self, explicit=False, bashrc=True, profile='profile_cc.sh'):
         """
         Add changes to a bashrc file.
@@ -203,8 +321,11 @@ class Interface(Parser):
         import shutil
         print('status cleaning')
         fns = [i for j in [glob.glob(k) for k in [
-            'miniconda', 'cc.yaml', '__pycache__',
-            'config.json', '*.pyc', 'cache.json',
+            'miniconda', 'cc.yaml', 'cc.yaml.lock', 'cc.yaml.flock',
+            'cc.yaml.tmp', '__pycache__', 'config.json', '*.pyc',
+            'cache.json', 'cache.json.journal', 'cache.json.bad',
+            'cache.json.flock', 'registry.json',
+            'modulefiles_store', 'spider_cache',
             'modules', 'stage', 'lmod', 'Miniconda*.sh', 'tmp',
             'spack', 'singularity', 'profile_cc.sh',
             ]] for i in j]
@@ -214,14 +335,23 @@ class Interface(Parser):
         if not dryrun:
             if sure or confirm('okay to remove the files above?',):
                 for fn in fns:
-                    shutil.rmtree(fn) if os.path.isdir(fn) else os.remove(fn)
+                    # modulefiles are links into the store
+                    if os.path.isdir(fn) and not os.path.islink(fn):
+                        shutil.rmtree(fn)
+                    else:
+                        os.remove(fn)
                 print('status done')
 
-    def showcache(self):
+    def showcache(self, trace=False):
         """
         Print the internal cache for the cc program during debugging.
+        Use trace to list the accesses to the state recorded by the last
+        "./cc refresh --debug" instead.
         """
-        self.cache._debug = False
+        if trace:
+            for accessor, key, caller in self.cache.get('trace', []):
+                print('%s %s %s' % (accessor.ljust(4), caller.ljust(24), key))
+            return
         from cc_tools.stdtools import treeview
         treeview(self.cache, style='json')
 
@@ -325,6 +455,10 @@ class Interface(Parser):
         if name not in commands:
             raise Exception('invalid test "%s". select from: %s' % (
                 name, commands.keys()))
+        # the commands below use the cache so we release it and leave
+        #   their changes in place when we exit
+        self.cache['languish'] = True
+        self._unlock()
         for cmd in commands[name]:
             # bash function fails here with ascii error bash(cmd,announce=True)
             # issue: fix the bash function and replace the system call below
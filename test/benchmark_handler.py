@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+
+"""
+Time Handler dispatch over a synthetic whitelist with 5,000 entries.
+Run from the root of the repository with: python -m test.benchmark_handler
+This is not collected by pytest.
+"""
+
+from __future__ import print_function
+
+import time
+
+from cc_tools.execute import whitelist_requests
+from cc_tools.execute import ModuleRequest
+from cc_tools.installers import LmodManager
+
+size = 5000
+
+
+def synthetic_whitelist(size):
+    """Mix the whitelist styles from cc.yaml."""
+    whitelist = {}
+    for num in range(size):
+        name = 'tool%d' % num
+        if num % 3 == 0:
+            whitelist[name] = '>=%d.0' % (num % 7)
+        elif num % 3 == 1:
+            whitelist[name] = {'repo': 'org/%s' % name, 'version': 'latest',
+                               'calls': [name]}
+        else:
+            whitelist[name] = {'version': '>=1.0', 'gpu': True, 'shell': True,
+                               'semantic_version': 'MAJOR.MINOR'}
+    return whitelist
+
+
+def timed(label, function, *args):
+    start = time.time()
+    result = function(*args)
+    print('%s: %.3fs' % (label.ljust(36), time.time() - start))
+    return result
+
+
+def classify_all(handler, classify, keysets):
+    return [getattr(handler, classify)(*keys) for keys in keysets]
+
+
+if __name__ == '__main__':
+    whitelist = synthetic_whitelist(size)
+    prepped = timed('prepare %d entries' % size,
+                    whitelist_requests, whitelist)
+    keysets = [list(item.keys()) for item in prepped]
+    # instances made for inspection infer the taxonomy but run nothing
+    handler = ModuleRequest(inspect=True)
+    scanned = timed('ModuleRequest scan', classify_all,
+                    handler, '_classify_scan', keysets)
+    dispatched = timed('ModuleRequest dispatch', classify_all,
+                       handler, '_classify', keysets)
+    assert scanned == dispatched
+    keysets = [['root'], ['root', 'lua'], ['build'], ['error', 'root']]
+    keysets = keysets * (size // len(keysets))
+    handler = LmodManager(inspect=True)
+    scanned = timed('LmodManager scan', classify_all,
+                    handler, '_classify_scan', keysets)
+    dispatched = timed('LmodManager dispatch', classify_all,
+                       handler, '_classify', keysets)
+    assert scanned == dispatched
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+import os
+import tempfile
+
+from cc_tools.execute import whitelist_filter
+from cc_tools.execute import publish_modulefiles
+from cc_tools.execute import rollback_modulefiles
+from cc_tools import execute
+
+
+def publish(entries):
+    """Write new entries in the store like ModuleRequest and publish them."""
+    for entry in entries.values():
+        dn = os.path.join('modulefiles_store', 'entries', entry)
+        if not os.path.isdir(dn):
+            os.makedirs(dn)
+            with open(os.path.join(dn, '.base.lua'), 'w') as fp:
+                fp.write('-- %s\n' % entry)
+    return publish_modulefiles('modulefiles', entries)
+
+
+def published():
+    """Read the entry behind each module in the modulefiles tree."""
+    return dict([(name, open(os.path.join(
+        'modulefiles', name, '.base.lua')).read().split()[-1])
+        for name in os.listdir('modulefiles') if name != 'cc'])
+
+
+def generations():
+    return sorted([i for i in os.listdir('modulefiles_store')
+                   if i.startswith('gen-')])
+
+
+def test_modulefile_generations(monkeypatch):
+    """
+    Publish generations of modulefiles, roll back, and prune the store
+    """
+    monkeypatch.chdir(tempfile.mkdtemp())
+    os.makedirs(os.path.join('modulefiles', 'cc'))
+    whitelist = {'julia': '>=1.0', 'R': '>=3.6'}
+    entries = {'julia': 'julia-aa', 'R': 'R-aa'}
+    assert publish(entries)
+    assert published() == entries
+    first = generations()
+    # unchanged content does not make a new generation
+    assert not publish(dict(entries))
+    assert generations() == first
+    assert not os.path.lexists(os.path.join('modulefiles_store', 'previous'))
+    # a blacklisted module leaves the tree
+    assert publish(dict([
+        (name, entries[name])
+        for name in whitelist_filter(whitelist, ['R'])]))
+    assert published() == {'julia': 'julia-aa'}
+    second = [i for i in generations() if i not in first]
+    assert os.readlink(os.path.join('modulefiles_store', 'previous')) == \
+        first[0]
+    # roll back and then undo the rollback
+    rollback_modulefiles('modulefiles')
+    assert published() == entries
+    assert os.readlink(os.path.join('modulefiles_store', 'previous')) == \
+        second[0]
+    rollback_modulefiles('modulefiles')
+    assert published() == {'julia': 'julia-aa'}
+    rollback_modulefiles('modulefiles')
+    # only the current and previous generations and their entries are kept
+    assert publish({'julia': 'julia-bb'})
+    assert publish({'julia': 'julia-cc'})
+    assert len(generations()) == 2 and first[0] not in generations()
+    assert sorted(os.listdir(os.path.join(
+        'modulefiles_store', 'entries'))) == ['julia-bb', 'julia-cc']
+    assert published() == {'julia': 'julia-cc'}
+    assert os.path.isdir(os.path.join('modulefiles', 'cc'))
+
+
+def test_modulefile_flip(monkeypatch):
+    """
+    Change the set of visible modules only when the current link flips
+    """
+    monkeypatch.chdir(tempfile.mkdtemp())
+    os.makedirs(os.path.join('modulefiles', 'cc'))
+    publish({'julia': 'julia-aa', 'R': 'R-aa'})
+    flip_link, seen = execute.flip_link, []
+
+    def visible():
+        # dangling links are invisible to Lmod
+        return sorted([i for i in os.listdir('modulefiles')
+                       if i != 'cc' and
+                       os.path.exists(os.path.join('modulefiles', i))])
+
+    def flip(link, target):
+        flip_link(link, target)
+        if link == os.path.join('modulefiles_store', 'current'):
+            seen.append(visible())
+    monkeypatch.setattr(execute, 'flip_link', flip)
+    publish({'julia': 'julia-aa', 'python': 'python-aa'})
+    # the whole new set is visible as soon as the current link flips
+    assert seen == [['julia', 'python']]
+    assert visible() == ['julia', 'python']
+    rollback_modulefiles('modulefiles')
+    assert seen == [['julia', 'python'], ['R', 'julia']]
+    assert visible() == ['R', 'julia']
@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+
+import os
+import time
+import tempfile
+import subprocess
+
+from cc_tools.images import index_images
+from cc_tools.images import read_index
+from cc_tools.images import forget_images
+from cc_tools.images import collect_images
+from cc_tools.images import index_lock
+from cc_tools.images import prefetch_images
+
+
+def test_index_ledger():
+    """
+    Keep image sizes in the index and measure only new or unknown images
+    """
+    dn = tempfile.mkdtemp()
+    with open(os.path.join(dn, 'julia-1.1.sif'), 'w') as fp:
+        fp.write('x' * 100)
+    os.makedirs(os.path.join(dn, 'R-3.6.sif', 'bin'))
+    with open(os.path.join(dn, 'R-3.6.sif', 'bin', 'R'), 'w') as fp:
+        fp.write('x' * 10)
+    assert index_images(dn) == {'julia-1.1.sif': 100, 'R-3.6.sif': 10}
+    # a known size is trusted until we rescan
+    with open(os.path.join(dn, 'julia-1.1.sif'), 'a') as fp:
+        fp.write('x' * 100)
+    assert index_images(dn)['julia-1.1.sif'] == 100
+    assert index_images(dn, rescan=True)['julia-1.1.sif'] == 200
+    forget_images(dn, ['R-3.6.sif'])
+    assert read_index(dn) == {'julia-1.1.sif': 200}
+
+
+def test_index_lock():
+    """
+    Lock the index like post_download.lua and expire locks left behind
+    """
+    dn = tempfile.mkdtemp()
+    lock = os.path.join(dn, '.cc_index.lock')
+    with index_lock(dn):
+        assert os.path.isdir(lock)
+        # a recent lock is not stale even when we do not wait
+        os.utime(lock, (time.time() + 100, time.time() + 100))
+        try:
+            with index_lock(dn, timeout=0):
+                pass
+        except Exception as e:
+            assert 'timed out' in str(e)
+        else:
+            raise AssertionError('took a lock that was held')
+    assert not os.path.exists(lock)
+    # a killed process leaves a lock which expires after the timeout
+    os.mkdir(lock)
+    os.utime(lock, (0, 0))
+    with open(os.path.join(dn, 'julia-1.1.sif'), 'w') as fp:
+        fp.write('x' * 100)
+    assert index_images(dn) == {'julia-1.1.sif': 100}
+    assert not os.path.exists(lock)
+
+
+def test_collect_images():
+    """
+    Remove the least recently loaded images that no modulefile refers to
+    """
+    dn, modulefiles = tempfile.mkdtemp(), tempfile.mkdtemp()
+    os.makedirs(os.path.join(modulefiles, 'julia'))
+    os.symlink('.base.lua', os.path.join(modulefiles, 'julia', '1.1.lua'))
+    for name in ['julia-1.0.sif', 'julia-1.1.sif', 'R-3.5.sif']:
+        with open(os.path.join(dn, name), 'w') as fp:
+            fp.write('x' * 100)
+    with open(os.path.join(dn, '.cc_access'), 'w') as fp:
+        fp.write('R-3.5.sif\t200\njulia-1.0.sif\t100\n')
+    assert collect_images(dn, modulefiles, budget=250, dryrun=True) == [
+        'julia-1.0.sif']
+    assert os.path.isfile(os.path.join(dn, 'julia-1.0.sif'))
+    assert collect_images(dn, modulefiles) == ['julia-1.0.sif', 'R-3.5.sif']
+    assert sorted(os.listdir(dn)) == ['.cc_access', '.cc_index',
+                                      'julia-1.1.sif']
+
+
+def test_collect_store():
+    """
+    Keep stored images which are named by a hardlink or a symlink
+    """
+    dn, modulefiles = tempfile.mkdtemp(), tempfile.mkdtemp()
+    store = os.path.join(dn, '.store')
+    os.makedirs(store)
+    for name in ['sha256-aa.sif', 'sha256-bb.sif', 'sha256-cc.sif']:
+        with open(os.path.join(store, name), 'w') as fp:
+            fp.write('x' * 100)
+    # filesystems without hardlinks fall back to a symlink
+    os.symlink('.store/sha256-aa.sif', os.path.join(dn, 'julia-1.1.sif'))
+    os.link(os.path.join(store, 'sha256-bb.sif'),
+            os.path.join(dn, 'R-3.6.sif'))
+    with open(os.path.join(dn, 'R-3.5.sif'), 'w') as fp:
+        fp.write('x' * 100)
+    with open(os.path.join(dn, '.cc_access'), 'w') as fp:
+        fp.write('R-3.5.sif\t100\njulia-1.1.sif\t200\nR-3.6.sif\t300\n')
+    # images removed outside of cc and links to removed store entries
+    with open(os.path.join(dn, '.cc_index'), 'w') as fp:
+        fp.write('gone-1.0.sif\t100\n')
+    os.symlink('.store/sha256-ee.sif', os.path.join(dn, 'gone-2.0.sif'))
+    # a download which has moved into the store but is not yet linked
+    with open(os.path.join(store, 'sha256-dd.sif'), 'w') as fp:
+        fp.write('x' * 100)
+    os.mkdir(os.path.join(store, 'sha256-dd.lock'))
+    assert collect_images(dn, modulefiles, budget=250) == ['R-3.5.sif']
+    assert sorted(os.listdir(store)) == [
+        'sha256-aa.sif', 'sha256-bb.sif', 'sha256-dd.lock', 'sha256-dd.sif']
+    assert os.path.isfile(os.path.join(dn, 'julia-1.1.sif'))
+    assert not os.path.lexists(os.path.join(dn, 'gone-2.0.sif'))
+    assert sorted(read_index(dn)) == ['R-3.6.sif', 'julia-1.1.sif']
+
+
+def test_stage_symlink():
+    """
+    Reuse the node-local copy of an image that is named by a symlink
+    """
+    dn, local_dn = tempfile.mkdtemp(), tempfile.mkdtemp()
+    os.makedirs(os.path.join(dn, '.store'))
+    with open(os.path.join(dn, '.store', 'sha256-aa.sif'), 'w') as fp:
+        fp.write('x' * 100)
+    os.symlink('.store/sha256-aa.sif', os.path.join(dn, 'julia-1.1.sif'))
+    script = os.path.join(os.path.dirname(__file__), '..', 'cc_tools',
+                          'stage_image.sh')
+    for copies in [1, 0]:
+        proc = subprocess.Popen(
+            ['bash', script, local_dn, '150',
+             os.path.join(dn, 'julia-1.1.sif')],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        assert stdout.decode().strip() == os.path.join(
+            local_dn, 'julia-1.1.sif')
+        assert stderr.decode().count('copying') == copies
+
+
+def test_prefetch_bandwidth():
+    """
+    Pace the downloads so that the average rate stays under the cap
+    """
+    dn, singularity = tempfile.mkdtemp(), tempfile.mkdtemp()
+    os.makedirs(os.path.join(singularity, 'bin'))
+    fake = os.path.join(singularity, 'bin', 'singularity')
+    # the pull script calls: singularity pull <temporary file> <source>
+    with open(fake, 'w') as fp:
+        fp.write('#!/bin/bash\nhead -c 50000 /dev/zero > "$2"\n')
+    os.chmod(fake, 0o755)
+    requests = [dict(name='julia', digest='', source='docker://julia:%s' % i,
+                     target='julia-%s.sif' % i) for i in ['1.0', '1.1']]
+    start = time.time()
+    assert prefetch_images(requests, dn, singularity, workers=1,
+                           bandwidth=100) == ['julia-1.0.sif', 'julia-1.1.sif']
+    assert time.time() - start >= 1
+    assert read_index(dn) == {'julia-1.0.sif': 50000, 'julia-1.1.sif': 50000}
+
+
+def test_pull_stale_lock():
+    """
+    Clear the locks left by killed downloads without waiting for the timeout
+    """
+    import socket
+    dn = tempfile.mkdtemp()
+    script = os.path.join(os.path.dirname(__file__), '..', 'cc_tools',
+                          'pull_image.sh')
+    # owners on this host that have exited and owners that stopped beating
+    for name, owner, mtime in [
+            ('julia-1.0.sif', '%s:999999999' % socket.gethostname(), None),
+            ('julia-1.1.sif', 'elsewhere:1', time.time() - 120)]:
+        lock = os.path.join(dn, '.%s.lock' % name)
+        os.mkdir(lock)
+        with open(os.path.join(lock, 'owner'), 'w') as fp:
+            fp.write(owner + '\n')
+        if mtime:
+            os.utime(lock, (mtime, mtime))
+        start = time.time()
+        proc = subprocess.Popen(
+            ['bash', script, '30', os.path.join(dn, name), 'docker://julia',
+             '', 'bash', '-c', 'echo image > "$0"'],
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr = proc.communicate()[1].decode()
+        assert proc.returncode == 0 and time.time() - start < 10
+        assert 'removing a stale lock from %s' % owner in stderr
+        assert os.path.isfile(os.path.join(dn, name))
+        assert not os.path.exists(lock)
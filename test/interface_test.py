@@ -19,10 +19,11 @@ def test_flake8():
     with patch.object(sys, 'argv', ['cc', 'flake8']):
         pyfiles = Interface().flake8()
     assert ['cc_tools/__init__.py', 'cc_tools/execute.py',
-            'cc_tools/installers.py', 'cc_tools/misc.py',
-            'cc_tools/modulefile_templates.py', 'cc_tools/settings.py',
-            'cc_tools/statetools.py', 'cc_tools/stdtools.py',
-            'interface.py'] == pyfiles
+            'cc_tools/images.py', 'cc_tools/installers.py',
+            'cc_tools/misc.py', 'cc_tools/modulefile_templates.py',
+            'cc_tools/registry.py', 'cc_tools/runner.py',
+            'cc_tools/settings.py', 'cc_tools/statetools.py',
+            'cc_tools/stdtools.py', 'interface.py'] == pyfiles
 
 
 def test_profile_cc_file():
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+import io
+import os
+import json
+import tempfile
+import urllib.error
+import urllib.request
+
+from cc_tools.registry import write_snapshot
+from cc_tools.registry import read_snapshot
+from cc_tools.registry import VersionIndex
+from cc_tools.registry import TagCache
+from cc_tools.registry import fetch_tags
+from cc_tools.execute import VersionCheck
+
+
+def test_snapshot_offline_versions():
+    """
+    Resolve a version constraint from a tag snapshot without the network
+    """
+    fn = os.path.join(tempfile.mkdtemp(), 'tags_snapshot.json')
+    write_snapshot({'julia': ['1.0.0', '1.0.2', '1.1', 'latest']}, fn=fn)
+    tags = read_snapshot(['julia', 'r-base'], fn=fn)
+    assert isinstance(tags['r-base'], Exception)
+    versions = VersionCheck(name='julia', docker_version='>=1.0.1',
+                            tags=tags['julia']).solve
+    assert versions == ['1.0.2', '1.1']
+
+
+def test_version_index_queries():
+    """
+    Check the version operators against the precompiled tag index
+    """
+    index = VersionIndex(['3.5', '3.6', '3.6.1', '3.10', '3.6-x', 'latest'])
+
+    def check(version, **kwargs):
+        return VersionCheck(name='r-base', docker_version=version,
+                            tags=index, **kwargs).solve
+    assert check('>=3.6') == ['3.6', '3.6.1', '3.10']
+    assert check('>3.6') == ['3.6.1', '3.10']
+    assert check('3.6') == ['3.6']
+    assert check('3.6-x') == ['3.6-x']
+    assert check('latest') == ['latest']
+    assert check('>=3.6', semantic_version='MAJOR.MINOR') == ['3.6', '3.10']
+    assert index.select('>=', '3.6', clean=False) == [
+        '3.6', '3.6-x', '3.6.1', '3.10']
+    # digests are kept for the tags which have them
+    index = VersionIndex({'3.6': 'sha256:abc', '3.7': None})
+    assert index.digests == {'3.6': 'sha256:abc'}
+    assert VersionCheck(name='r-base', docker_version='>=3.6',
+                        tags=index).solve == ['3.6', '3.7']
+
+
+def test_partial_tags(monkeypatch):
+    """
+    Keep only the wanted tags while paging and revalidate them from the cache
+    """
+    pages = [['latest', '2.0'], ['1.15-gpu-py3', '1.0'], ['0.9']]
+    requests = []
+
+    def urlopen(request):
+        # the first url has a page size and later ones have a page number
+        number = int(request.full_url.rpartition('page=')[2]) \
+            if 'page=' in request.full_url else 1
+        requests.append(number)
+        if number == 1 and request.get_header('If-none-match') == '"v1"':
+            raise urllib.error.HTTPError(
+                request.full_url, 304, 'Not Modified', {}, None)
+        response = io.BytesIO(json.dumps(dict(
+            results=[dict(name=i, digest='sha256:%s' % i)
+                     for i in pages[number - 1]],
+            next=('https://hub.docker.com/next?page=%d' % (number + 1)
+                  if number < len(pages) else None))).encode('utf-8'))
+        response.headers = {'ETag': '"v1"'} if number == 1 else {}
+        return response
+    monkeypatch.setattr(urllib.request, 'urlopen', urlopen)
+    cache = TagCache(fn=os.path.join(tempfile.mkdtemp(), 'registry.json'),
+                     ttl=0)
+    wanted = set(['1.15-gpu-py3'])
+    assert fetch_tags('tensorflow/tensorflow', cache=cache,
+                      wanted=wanted) == {'1.15-gpu-py3': 'sha256:1.15-gpu-py3'}
+    assert requests == [1, 2]
+    assert cache.lookup('tensorflow/tensorflow')['partial']
+    # an unchanged repository costs a single request
+    assert fetch_tags('tensorflow/tensorflow', cache=cache,
+                      wanted=wanted) == {'1.15-gpu-py3': 'sha256:1.15-gpu-py3'}
+    assert requests == [1, 2, 1]
+    # the partial entry cannot answer a request for the full list
+    assert len(fetch_tags('tensorflow/tensorflow', cache=cache)) == 5
+    assert requests == [1, 2, 1, 1, 2, 3]
+    assert not cache.lookup('tensorflow/tensorflow')['partial']
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import tempfile
+import threading
+
+import pytest
+
+from cc_tools import stdtools
+from cc_tools.execute import run_managers
+from cc_tools.runner import run_commands
+from cc_tools.stdtools import Handler
+from cc_tools.stdtools import command_check
+from cc_tools.stdtools import probe
+from cc_tools.stdtools import shell_free
+from cc_tools.stdtools import tag_output
+
+
+# the runner needs python 3.8 and stdtools uses subprocess before that
+needs_runner = pytest.mark.skipif(
+    sys.version_info < (3, 8), reason='the runner requires python 3.8')
+
+
+@needs_runner
+def test_run_commands():
+    """
+    Run commands at the same time and stop the ones that take too long
+    """
+    start = time.time()
+    results = run_commands(
+        ['sleep 0.5; echo one', 'sleep 0.5; exit 3', 'sleep 5'],
+        timeout=2, scroll=False)
+    assert time.time() - start < 4
+    assert [i['returncode'] for i in results] == [0, 3, -1]
+    assert results[0]['stdout'] == 'one'
+    assert [i['timeout'] for i in results] == [False, False, True]
+
+
+def test_command_check():
+    """
+    Run simple probes without a shell and keep bash return codes
+    """
+    assert shell_free('which which') == ['which', 'which']
+    assert shell_free('which lua || true') is None
+    assert command_check('which which') == 0
+    assert command_check('missing-command-for-cc') == 127
+
+
+def test_command_check_subprocess(monkeypatch):
+    """
+    Check commands without the runner as on python before 3.8
+    """
+    monkeypatch.setattr(stdtools, 'use_runner', False)
+    assert command_check('which which') == 0
+    assert command_check('missing-command-for-cc') == 127
+    if sys.version_info >= (3, 3):
+        assert command_check('sleep 5', timeout=1, quiet=True) == -1
+    assert probe({}, 'echo 1.2.3')['stdout'] == '1.2.3'
+
+
+def test_probe_cache():
+    """
+    Reuse successful probes until the program changes
+    """
+    dn = tempfile.mkdtemp()
+    script = os.path.join(dn, 'tool')
+    with open(script, 'w') as fp:
+        fp.write('#!/bin/bash\necho run >> %s/runs\necho 1.2.3\n' % dn)
+    os.chmod(script, 0o755)
+    probes = {}
+    assert probe(probes, './tool --version', cwd=dn)['stdout'] == '1.2.3'
+    assert probe(probes, './tool --version', cwd=dn)['stdout'] == '1.2.3'
+    with open(os.path.join(dn, 'runs')) as fp:
+        assert len(fp.readlines()) == 1
+    # a new version of the program is probed again
+    os.utime(script, (0, 0))
+    probe(probes, './tool --version', cwd=dn)
+    with open(os.path.join(dn, 'runs')) as fp:
+        assert len(fp.readlines()) == 2
+    # failures are not remembered
+    assert probe(probes, './missing', cwd=dn)['returncode'] == 127
+    assert len(probes) == 1
+
+
+@needs_runner
+def test_tagged_threads(capsys):
+    """
+    Tag the command output from each thread with the name of the thread
+    """
+    def run(name):
+        tag_output('[%s]' % name)
+        run_commands(['echo %s' % name])
+        tag_output(None)
+    threads = [threading.Thread(target=run, args=(name,))
+               for name in ['lmod', 'singularity']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    lines = sorted(capsys.readouterr().out.splitlines())
+    assert lines == ['[lmod] lmod', '[singularity] singularity']
+
+
+def test_run_managers():
+    """
+    Register the exceptions from managers unless they explained them first
+    """
+    class Manager(Handler):
+        def install(self, fail, explain=None):
+            if explain:
+                self._register_error(name=explain, error='explained')
+            if fail:
+                raise Exception('failed in this run')
+
+    class UseCase(object):
+        _debug = False
+        # errors stay in the cache from earlier runs
+        cache = {'errors': {'old': 'failed in an earlier run'}}
+    use = UseCase()
+    instances = run_managers(use, [
+        ('good', Manager, dict(fail=False)),
+        ('old', Manager, dict(fail=True)),
+        ('explained', Manager, dict(fail=True, explain='explained'))])
+    assert instances['good'].solve is None
+    assert instances['old'] is None and instances['explained'] is None
+    assert use.cache['errors']['old']['result'] == 'failed in this run'
+    assert use.cache['errors']['explained'] == 'explained'
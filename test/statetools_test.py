@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import tempfile
+
+from cc_tools.statetools import Cacher
+from cc_tools.statetools import StateDict
+from cc_tools.statetools import Convey
+from cc_tools.stdtools import Handler
+from cc_tools.stdtools import lock_file
+from cc_tools.stdtools import lock_wait
+from cc_tools.stdtools import lock_command
+
+
+def cached_class(cache_fn, journal_limit=50, cache=None):
+    """Make a fresh cached class since Cacher binds the cache object."""
+    @Cacher(cache_fn=cache_fn, cache={} if cache is None else cache,
+            cache_policy='journal',
+            journal_limit=journal_limit)
+    class Task(object):
+        pass
+    return Task()
+
+
+def test_journal_cache():
+    """
+    Save changes to a journal and fold them into the cache when it is long
+    """
+    cache_fn = os.path.join(tempfile.mkdtemp(), 'cache.json')
+    for num in range(3):
+        task = cached_class(cache_fn, journal_limit=2)
+        task.cache.setdefault('log', []).append(num)
+        task.cache['last'] = num
+        task._try_else()
+    # the first save has no journal to fold into the cache file
+    with open(cache_fn) as fp:
+        assert json.load(fp) == {'log': [0], 'last': 0, '_journal': 0}
+    with open('%s.journal' % cache_fn) as fp:
+        assert [json.loads(i)['delta'] for i in fp] == [
+            {'extend': {'log': [1]}, 'set': {'last': 1}},
+            {'extend': {'log': [2]}, 'set': {'last': 2}}]
+    # a partial line from an interrupted save is ignored
+    with open('%s.journal' % cache_fn, 'a') as fp:
+        fp.write('{"seq": 3, "del')
+    task = cached_class(cache_fn, journal_limit=2)
+    assert task.cache == {'log': [0, 1, 2], 'last': 2}
+    task.cache['log'].append(3)
+    task._try_else()
+    assert not os.path.isfile('%s.journal' % cache_fn)
+    assert cached_class(cache_fn).cache == {'log': [0, 1, 2, 3], 'last': 2}
+
+
+def test_state_changes():
+    """
+    Track the changed keys of the state without copying it
+    """
+    state = StateDict(case={'lmod': 'lmod'}, log=[])
+    state.settle()
+    assert not state.changed
+    state['log'].append({'function_name': 'refresh'})
+    state['case']['images'] = {'dn': 'images'}
+    state['case']['images']['dn'] = 'other'
+    state.pop('missing', None)
+    assert state.delta() == {
+        'extend': {'log': [{'function_name': 'refresh'}]},
+        'set': {'case': {'lmod': 'lmod', 'images': {'dn': 'other'}}}}
+    state.settle()
+    state['log'] += [1]
+    state['log'][0] = 2
+    del state['case']
+    assert state.delta() == {'set': {'log': [2, 1]}, 'del': ['case']}
+    # the cacher saves the changes from the state to the journal
+    cache_fn = os.path.join(tempfile.mkdtemp(), 'cache.json')
+    task = cached_class(cache_fn, cache=StateDict())
+    task.cache['log'] = [0]
+    task._try_else()
+    task = cached_class(cache_fn, cache=StateDict())
+    task.cache['log'].append(1)
+    task._try_else()
+    with open('%s.journal' % cache_fn) as fp:
+        assert json.loads(fp.read())['delta'] == {'extend': {'log': [1]}}
+    assert cached_class(cache_fn, cache=StateDict()).cache == {'log': [0, 1]}
+
+
+def test_lock_file():
+    """
+    Share locks between readers and refuse a writer when asked not to wait
+    """
+    fn = os.path.join(tempfile.mkdtemp(), 'cc.yaml')
+    assert lock_wait(['--no-wait', 'refresh']) is False
+    assert lock_wait(['refresh']) is True
+    readers = [lock_file(fn, shared=True, wait=False) for i in range(2)]
+    try:
+        lock_file(fn, wait=False)
+    except Exception as e:
+        assert 'another command is using' in str(e)
+    else:
+        raise AssertionError('took the lock from the readers')
+    for reader in readers:
+        reader.close()
+    lock_file(fn, wait=False).close()
+
+
+def test_read_commands(monkeypatch):
+    """
+    Share the cache lock between commands that only read the cache
+    """
+    fn = os.path.join(tempfile.mkdtemp(), 'cache.json')
+    assert lock_command(['--no-wait', 'snapshot-tags']) == 'snapshot_tags'
+    monkeypatch.setattr(sys, 'argv', ['cc', '--no-wait', 'showcache'])
+
+    @Cacher(cache_fn=fn, cache={}, read_commands=('showcache',))
+    class Reader(object):
+        pass
+    readers = [Reader() for i in range(2)]
+    assert all(reader.cache_read for reader in readers)
+    try:
+        lock_file(fn, wait=False)
+    except Exception as e:
+        assert 'another command is using' in str(e)
+    else:
+        raise AssertionError('took the lock from the readers')
+    readers[0].cache['key'] = 'value'
+    readers[0]._try_else()
+    readers[1]._try_else()
+    assert not os.path.isfile(fn)
+    lock_file(fn, wait=False).close()
+
+
+def test_state_trace():
+    """
+    Record the accesses to a traced state in a ring buffer
+    """
+    state = StateDict(log=[])
+    assert type(state) is StateDict
+    state.trace(size=2)
+    state['case'] = {}
+    state.get('case')
+    state['log'].append(1)
+    state.save_trace()
+    assert [i[:2] for i in state['trace']] == [['get', 'case'], ['get', 'log']]
+    assert state['trace'][0][2].startswith('statetools_test.py:')
+    assert state.delta()['set']['trace'] == state['trace']
+
+
+def test_handler_taxonomy():
+    """
+    Infer the taxonomy once for a Handler and share it with Convey subclasses
+    """
+    class Request(Handler):
+        def exact(self, version):
+            self.picked = version
+            return 'exact'
+
+        def spread(self, versions, latest=False):
+            return 'spread'
+
+    assert Request(version='1.0').solve == 'exact'
+    memo = Request.__dict__['_taxonomy_memo']
+    conveyed = Convey(tags={})(Request)
+    assert conveyed(versions=['1.0'], latest=True).solve == 'spread'
+    assert '_taxonomy_memo' not in conveyed.__dict__
+    assert Request.__dict__['_taxonomy_memo'] is memo
+    assert Request(version='1.1')._novel == ('picked',)